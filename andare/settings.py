@@ -96,6 +96,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'app.metrics.MetricsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     #'django.middleware.csrf.CsrfViewMiddleware',
@@ -166,3 +167,71 @@ GIT_REMOTE = 'origin'
 GIT_REMOTE_BRANCH = 'origin/master'
 GIT_LOCAL_BRANCH = 'master'
 GIT_LOCAL_FETCHED = 'fetched'
+
+# Rendered html cache. Entries are keyed by blob SHA, so they never go stale.
+# The second tier lives under RENDER_CACHE_DIR and is shared by all worker
+# processes, which also coordinate there so that only one of them renders a
+# given page at a time.
+RENDER_CACHE_MEMORY_SIZE = 64 * 1024 * 1024  # bytes
+RENDER_CACHE_DIR = None                      # e.g. os.path.join(PROJECT_DIR, 'cache', 'render'). None disables the shared tier.
+RENDER_CACHE_BACKEND = 'disk'                # 'disk' (one file per entry) or 'sqlite'
+RENDER_CACHE_DISK_SIZE = 1024 * 1024 * 1024  # bytes
+
+# GitHub API client shared by all requests in a process.
+GITHUB_API_URL = 'https://api.github.com'
+GITHUB_POOL_SIZE = 10                       # keep-alive connections
+GITHUB_ETAG_CACHE_SIZE = 32 * 1024 * 1024   # bytes of responses kept for If-None-Match
+GITHUB_HEAD_TTL = 30                        # seconds a fetched master SHA is reused; /start refreshes it
+# Once X-RateLimit-Remaining drops to the reserve, reads stop calling the API
+# (pages are served from the local fetched branch instead) and the rest is kept
+# for issue updates. A request that hits an exhausted budget waits for the reset
+# if it is at most GITHUB_RATE_LIMIT_MAX_WAIT seconds away, otherwise it fails.
+GITHUB_RATE_LIMIT_RESERVE = 100
+GITHUB_RATE_LIMIT_MAX_WAIT = 5              # seconds
+# commit id -> number of the "Update Error" issue, so /errors and /commit find
+# the issue with a single API call instead of paging through every issue.
+ISSUE_INDEX_PATH = '.issue_index.json'
+
+# Highlighted code blocks shared between pages, keyed by (language, code hash, formatter options).
+HIGHLIGHT_CACHE_SIZE = 32 * 1024 * 1024     # bytes
+
+# Rendered page responses are compressed once and kept next to the render in
+# the render cache; requests get the best variant their Accept-Encoding allows.
+# 'br' is used only when the brotli module is installed.
+PRECOMPRESS_ENCODINGS = ('br', 'gzip')     # in order of preference
+PRECOMPRESS_MIN_SIZE = 1024                # bytes; smaller bodies are sent as is
+
+# Full-text search index over the master branch, updated on /commit.
+SEARCH_INDEX_DIR = os.path.join(PROJECT_DIR, '..', 'cpprefjp', 'search')
+
+# Which pages link to which, filled in as pages are rendered. When /start adds or
+# deletes pages, only the pages linking to them are re-rendered.
+LINK_INDEX_PATH = os.path.join(PROJECT_DIR, '..', 'cpprefjp', 'links.sqlite3')
+
+# Cache-Control for rendered pages. The same URL changes whenever the branch
+# moves, so caches must revalidate; the ETag makes that a cheap 304.
+PAGE_CACHE_CONTROL = 'public, no-cache'
+
+# Import the views and render a sample page when a worker starts (andare/wsgi.py),
+# so the first request after a restart is as fast as the rest. The time it takes
+# is reported in /stats and /metrics.
+BOOT_WARM_UP = True
+
+# Threads used to render pages in the background (batch rendering etc.)
+RENDER_POOL_SIZE = 4
+WARM_UP_POOL_SIZE = 2  # threads pre-rendering changed pages after /start and /commit
+
+# /validate renders every added or modified page in separate processes. A page
+# taking longer than VALIDATE_TIMEOUT seconds is reported as an error and its
+# worker process is replaced. Validation runs beside /start and /commit and holds
+# the repository lock only while it picks the commit and pages to check.
+VALIDATE_PROCESSES = 4
+VALIDATE_TIMEOUT = 30
+
+# /start and /commit run as jobs on a background git worker. Jobs hold a lock
+# under GIT_DIR/.git while they run, so workers in different processes never
+# touch the working tree at the same time. Job state is kept in JOB_STORE_PATH
+# so any process can answer /jobs/<id>.
+JOB_HISTORY = 100  # finished jobs kept for /jobs/<id>
+JOB_STALE_AFTER = 60 * 60  # seconds after which an unfinished job is assumed to be left by a dead process
+JOB_STORE_PATH = os.path.join(PROJECT_DIR, '..', 'cpprefjp', 'jobs.sqlite3')
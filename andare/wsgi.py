@@ -14,6 +14,10 @@ framework.
 
 """
 import os
+import sys
+import time
+
+_started_at = time.time()
 
 # We defer to a DJANGO_SETTINGS_MODULE already in the environment. This breaks
 # if running multiple sites in the same mod_wsgi process. To fix this, use
@@ -27,6 +31,16 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "andare.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Import the views and render a sample page once before serving, so that the
+# first request does not pay for loading markdown extensions and Pygments lexers.
+from django.conf import settings
+from app import boot
+boot.record('django', time.time() - _started_at)
+if settings.BOOT_WARM_UP:
+    timings = boot.warm_up(_started_at)
+    print>>sys.stderr, 'andare: pid {pid} warmed up in {total:.3f}s (import {import:.3f}s, render {render:.3f}s)'.format(
+        pid=os.getpid(), **timings)
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)
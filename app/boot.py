@@ -0,0 +1,96 @@
+#coding: utf-8
+"""
+ワーカーの起動時に、変換に使うモジュールを読み込んで一度動かしておく
+
+markdown の拡張や Pygments の C++ の字句解析器は、最初に使ったときに読み込まれるので、
+何もしないと起動直後の最初のリクエストが遅くなる。andare/wsgi.py から warm_up を呼ぶと、
+リクエストを受ける前にそれを済ませる。かかった時間は /stats と /metrics で見られる。
+"""
+import os
+import time
+from app import metrics
+
+# 変換を一通り動かすためのページ
+SAMPLE_PATHS = ['reference', 'boot_warm_up.md']
+SAMPLE_MD = '''# boot warm-up
+* header[meta header]
+
+## 概要
+
+|a|b|
+|-|-|
+|1|2|
+
+```cpp
+#include <iostream>
+#include <vector>
+
+int main()
+{
+  std::vector<int> v = {1, 2, 3};
+  for (int x : v) {
+    std::cout << x << std::endl;
+  }
+}
+```
+'''
+
+# 段階 -> 秒
+_timings = {}
+_booted_at = None
+
+def _stage(name, func):
+    start = time.time()
+    result = func()
+    _timings[name] = time.time() - start
+    return result
+
+def _import_views():
+    # URL の設定を読むと、ビューとモデル (markdown, pygments など) が全て読み込まれる
+    from app import urls
+
+def _render_sample():
+    from django.conf import settings
+    from app import models
+    # 変換器はリクエストのスレッドと共有するプールにあるので、同時に来るリクエストの分
+    # (RENDER_POOL_SIZE 個) を作って一度ずつ動かし、プールに戻しておく
+    pool = models._converter_pool
+    converters = [pool.get() for _ in range(max(1, settings.RENDER_POOL_SIZE))]
+    for converter in converters:
+        converter.convert(unicode(SAMPLE_MD, 'utf-8'), models._page_extensions(SAMPLE_PATHS))
+    for converter in converters:
+        pool.put(converter)
+    # タイトルの切り出しなども含めて一度通しておく
+    models._render(SAMPLE_PATHS, SAMPLE_MD)
+
+def warm_up(process_started_at=None):
+    """ビューを読み込み、見本のページを一度変換する
+
+    process_started_at (wsgi.py を読み始めた時刻) を渡すと、そこからの時間も記録する。
+    """
+    global _booted_at
+    start = time.time()
+    _stage('import', _import_views)
+    _stage('render', _render_sample)
+    _booted_at = time.time()
+    _timings['warm_up'] = _booted_at - start
+    if process_started_at is not None:
+        _timings['total'] = _booted_at - process_started_at
+    return dict(_timings)
+
+def record(stage, seconds):
+    """warm_up の外で計った段階の時間を記録する"""
+    _timings[stage] = seconds
+
+def stats():
+    return {
+        'pid': os.getpid(),
+        'booted_at': _booted_at,
+        'seconds': dict(_timings),
+    }
+
+def _collect_metrics():
+    return [('andare_boot_seconds', 'gauge', 'Time spent starting the worker', {'stage': stage}, seconds)
+            for stage, seconds in sorted(_timings.items())]
+
+metrics.register_collector(_collect_metrics)
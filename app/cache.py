@@ -0,0 +1,256 @@
+#coding: utf-8
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from app.fileutil import write_atomic
+
+class LRUCache(object):
+    """合計サイズで上限を決める LRU キャッシュ
+
+    >>> cache = LRUCache(max_size=6)
+    >>> cache.set('a', 'aaa')
+    >>> cache.set('b', 'bbb')
+    >>> cache.get('a')
+    'aaa'
+    >>> cache.set('c', 'ccc')
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.stats().items())
+    [('entries', 2), ('evictions', 1), ('hits', 1), ('misses', 1), ('size', 6)]
+    """
+
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # 末尾が最も新しい
+            self._data[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._data:
+                _, old_size = self._data.pop(key)
+                self._size -= old_size
+            self._data[key] = (value, size)
+            self._size += size
+            while self._size > self.max_size:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                _, size = self._data.pop(key)
+                self._size -= size
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'entries': len(self._data),
+            'size': self._size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+class DiskCache(object):
+    """ディレクトリ以下にファイルとして保存するキャッシュ
+
+    合計サイズが max_size を超えたら、更新時刻の古いファイルから消していく。
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _files(self):
+        # 同じディレクトリに他のもの (SingleFlight のロックファイルなど) が置かれていても
+        # 数えたり消したりしないように、_path で作ったファイル (キーの先頭 2 文字の
+        # ディレクトリの中の、その 2 文字で始まるファイル) だけを見る。
+        # 書き込み中の一時ファイルもこれで除かれる。
+        try:
+            shards = [name for name in os.listdir(self.directory)
+                      if len(name) == 2 and os.path.isdir(os.path.join(self.directory, name))]
+        except OSError:
+            return
+        for shard in shards:
+            dirpath = os.path.join(self.directory, shard)
+            try:
+                filenames = os.listdir(dirpath)
+            except OSError:
+                continue
+            for filename in filenames:
+                if not filename.startswith(shard):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            self.misses += 1
+            return default
+        try:
+            # 最近使ったものを残すために更新時刻を進めておく
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def set(self, key, data):
+        if len(data) > self.max_size:
+            return
+        write_atomic(self._path(key), data)
+        with self._lock:
+            if self._size is None:
+                # 書き込んだファイルも含めて数える
+                self._size = sum(st.st_size for _, st in self._files())
+            else:
+                self._size += len(data)
+            if self._size > self.max_size:
+                self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        # 毎回溢れないように上限の 9 割まで減らす
+        target = self.max_size * 9 // 10
+        files = sorted(self._files(), key=lambda (path, st): st.st_mtime)
+        size = sum(st.st_size for _, st in files)
+        for path, st in files:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= st.st_size
+            self.evictions += 1
+        self._size = size
+
+    def stats(self):
+        return {
+            'size': self._size or 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+def make_key(*parts):
+    return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+def _sizeof_content(content):
+    # 圧縮済みのレスポンスなどはバイト列のまま入っている
+    if isinstance(content, str):
+        return len(content)
+    return len(content['title'] or '') + len(content['html'])
+
+class RenderCache(object):
+    """変換済みの html を保持するキャッシュ
+
+    キーは (blob の SHA, 変換器のバージョン, パス) から作る。
+    blob の SHA は内容が変われば必ず変わるので、エントリが古くなることはない。
+    メモリ上の LRU と、任意でプロセス間で共有するキャッシュ (DiskCache や
+    sharedcache.SQLiteCache) の二段になっている。
+    get_raw と set_raw は、圧縮済みのレスポンスのようなバイト列をそのまま出し入れする。
+    """
+
+    def __init__(self, memory_size, shared=None):
+        self.memory = LRUCache(memory_size, sizeof=_sizeof_content)
+        self.shared = shared
+
+    def get(self, key):
+        content = self.memory.get(key)
+        if content is not None:
+            return content
+        if self.shared is None:
+            return None
+        data = self.shared.get(key)
+        if data is None:
+            return None
+        content = json.loads(data)
+        self.memory.set(key, content)
+        return content
+
+    def set(self, key, content):
+        self.memory.set(key, content)
+        if self.shared is not None:
+            self.shared.set(key, json.dumps(content))
+
+    def get_raw(self, key):
+        data = self.memory.get(key)
+        if data is not None:
+            return data
+        if self.shared is None:
+            return None
+        data = self.shared.get(key)
+        if data is not None:
+            self.memory.set(key, data)
+        return data
+
+    def set_raw(self, key, data):
+        self.memory.set(key, data)
+        if self.shared is not None:
+            self.shared.set(key, data)
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def stats(self):
+        return {
+            'memory': self.memory.stats(),
+            'shared': self.shared.stats() if self.shared is not None else None,
+        }
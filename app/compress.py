@@ -0,0 +1,104 @@
+#coding: utf-8
+"""
+レスポンスを前もって圧縮しておき、Accept-Encoding を見て返すものを選ぶ
+
+brotli はモジュールがインストールされていれば使う。
+"""
+import gzip
+import zlib
+from cStringIO import StringIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 圧縮しないそのままのもの
+IDENTITY = 'identity'
+
+def _gzip(data):
+    out = StringIO()
+    # 時刻を埋め込むと同じ内容でも結果が変わるので 0 にする
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return out.getvalue()
+
+def _deflate(data):
+    return zlib.compress(data, 9)
+
+def _brotli(data):
+    return brotli.compress(data, quality=11)
+
+_COMPRESSORS = {
+    'gzip': _gzip,
+    'deflate': _deflate,
+}
+if brotli is not None:
+    _COMPRESSORS['br'] = _brotli
+
+def available(encodings):
+    """encodings のうち、この環境で使えるものを順番を保って返す"""
+    return [encoding for encoding in encodings if encoding in _COMPRESSORS]
+
+def compress_all(data, encodings, min_size=0):
+    """{エンコーディング: 圧縮したデータ} を返す。IDENTITY には元のデータが入る
+
+    min_size より小さいものや、圧縮しても小さくならなかったものは入れない。
+    """
+    variants = {IDENTITY: data}
+    if len(data) < min_size:
+        return variants
+    for encoding in available(encodings):
+        compressed = _COMPRESSORS[encoding](data)
+        if len(compressed) < len(data):
+            variants[encoding] = compressed
+    return variants
+
+def parse_accept_encoding(header):
+    """Accept-Encoding を {エンコーディング: q 値} にする
+
+    >>> sorted(parse_accept_encoding('gzip, deflate;q=0.5, br;q=0').items())
+    [('br', 0.0), ('deflate', 0.5), ('gzip', 1.0)]
+    >>> parse_accept_encoding('')
+    {}
+    """
+    result = {}
+    for item in header.split(','):
+        params = item.strip().split(';')
+        encoding = params[0].strip().lower()
+        if not encoding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        result[encoding] = q
+    return result
+
+def choose_encoding(header, encodings):
+    """Accept-Encoding に合う encodings の中のエンコーディングを返す
+
+    encodings は優先する順に並べる。どれも受け付けられなければ IDENTITY を返す。
+
+    >>> choose_encoding('gzip, deflate, br', ['br', 'gzip'])
+    'br'
+    >>> choose_encoding('gzip;q=0.5, br;q=0.1', ['br', 'gzip'])
+    'gzip'
+    >>> choose_encoding('*', ['gzip'])
+    'gzip'
+    >>> choose_encoding('br;q=0, *;q=0.1', ['br'])
+    'identity'
+    >>> choose_encoding('', ['gzip'])
+    'identity'
+    """
+    accepted = parse_accept_encoding(header)
+    best, best_q = IDENTITY, 0.0
+    for encoding in encodings:
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
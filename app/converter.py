@@ -0,0 +1,63 @@
+#coding: utf-8
+"""
+使い回せる Markdown 変換器
+
+markdown.Markdown を作るたびに、全ての拡張の設定の解析とプロセッサの生成が走る。
+ページによって変わらない拡張を入れた変換器をプールしておき、
+ページごとに変わる拡張だけを作り直して変換する。
+"""
+import threading
+import markdown
+
+class Converter(object):
+    def __init__(self, extensions):
+        self.md = markdown.Markdown(extensions)
+        self._extension_count = len(self.md.registeredExtensions)
+
+    def convert(self, text, page_extensions):
+        """page_extensions は (拡張の名前, [(設定名, 値), ...]) のリスト"""
+        md = self.md
+        # 前のページで登録された拡張を取り除く
+        del md.registeredExtensions[self._extension_count:]
+        md.reset()
+        for name, configs in page_extensions:
+            # 同じ名前のプロセッサは、登録済みの位置のまま置き換わる
+            extension = md.build_extension(name, configs)
+            extension.extendMarkdown(md, markdown.__dict__)
+        return md.convert(text)
+
+class ConverterPool(object):
+    """変換器を使い回すプール
+
+    変換する間だけ取り出して、終わったら戻す。リクエストごとにスレッドを作るサーバでも
+    使い回せるように、スレッドではなくプールに持たせる。
+    """
+
+    def __init__(self, extensions):
+        self.extensions = extensions
+        self.created = 0
+        self._free = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        """空いている変換器を取り出す。無ければ作る"""
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            self.created += 1
+        return Converter(self.extensions)
+
+    def put(self, converter):
+        with self._lock:
+            self._free.append(converter)
+
+    def convert(self, text, page_extensions):
+        converter = self.get()
+        result = converter.convert(text, page_extensions)
+        # 例外が出たものは状態が分からないので戻さない
+        self.put(converter)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'created': self.created, 'idle': len(self._free)}
@@ -0,0 +1,31 @@
+#coding: utf-8
+"""
+複数のプロセスから読み書きされるファイルの操作
+"""
+import os
+import tempfile
+
+def makedirs(dirname):
+    """dirname が無ければ作る。他のプロセスが同時に作っていてもエラーにしない"""
+    if not dirname or os.path.isdir(dirname):
+        return
+    try:
+        os.makedirs(dirname)
+    except OSError:
+        if not os.path.isdir(dirname):
+            raise
+
+def write_atomic(path, data, mode=0644):
+    """書きかけのファイルを読まれないように、一時ファイルに書いてから path に置き換える"""
+    dirname = os.path.dirname(path)
+    makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(dir=dirname or '.', prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp は自分しか読めないファイルを作る
+        os.chmod(tmp, mode)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
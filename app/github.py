@@ -0,0 +1,286 @@
+#coding: utf-8
+"""
+プロセス内で共有する GitHub API クライアント
+
+接続はセッションで使い回し、GET のレスポンスは ETag と一緒に覚えておいて
+If-None-Match を付けて問い合わせる。変わっていなければ 304 が返ってくるので、
+覚えておいた内容をそのまま返す。
+
+レスポンスの X-RateLimit-Remaining と X-RateLimit-Reset から残りの回数を覚えておき、
+残りが少なくなったら読み出しは API を呼ばずに RateLimitExceeded にする。
+書き込み（issue の作成や更新）は残りを使い切るまで呼び、使い切ったときは
+リセットまでが短ければ待ってから呼ぶ。
+"""
+import os
+import time
+import threading
+from django.conf import settings
+from app.cache import LRUCache
+
+ACCESS_TOKEN_PATH = '.access_token'
+
+class GithubError(Exception):
+    def __init__(self, status_code, message):
+        super(GithubError, self).__init__('{status}: {message}'.format(status=status_code, message=message))
+        self.status_code = status_code
+
+class RateLimitExceeded(GithubError):
+    def __init__(self, reset_at, message='API rate limit exceeded'):
+        super(RateLimitExceeded, self).__init__(403, message)
+        self.reset_at = reset_at
+
+# API の残り回数は種類ごとに別々に数えられる。issue の検索 (search) は、
+# ページの読み出しなど (core) とは別で、回数が少なくすぐにリセットされる
+CORE = 'core'
+SEARCH = 'search'
+
+class RateLimit(object):
+    """最後に見たレスポンスから分かる API の残り回数（一つの種類の分）"""
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        self.limited = 0
+        self._lock = threading.Lock()
+
+    def update(self, response):
+        headers = response.headers
+        try:
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset_at = float(headers['X-RateLimit-Reset'])
+        except (KeyError, ValueError):
+            return
+        with self._lock:
+            # 並行して返ってきた古いレスポンスで、残りを増やしてしまわないようにする
+            if self.reset_at is None or reset_at > self.reset_at or remaining < self.remaining:
+                self.remaining = remaining
+                self.reset_at = reset_at
+            if 'X-RateLimit-Limit' in headers:
+                self.limit = int(headers['X-RateLimit-Limit'])
+
+    def exhausted(self, reset_at):
+        with self._lock:
+            self.remaining = 0
+            self.reset_at = max(reset_at, self.reset_at or 0)
+
+    def check(self, reserve, max_wait):
+        """残りが reserve 以下なら、リセットまで待つか RateLimitExceeded にする"""
+        with self._lock:
+            if self.remaining is None or self.remaining > reserve:
+                return
+            wait = self.reset_at - time.time()
+            if wait <= 0:
+                # リセットされたはずなので、次のレスポンスで分かるまでは制限しない
+                self.remaining = None
+                return
+            if wait > max_wait:
+                self.limited += 1
+                raise RateLimitExceeded(self.reset_at)
+        time.sleep(wait)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'remaining': self.remaining,
+                'reset_at': self.reset_at,
+                'limited': self.limited,
+            }
+
+class _EndpointStats(object):
+    def __init__(self):
+        self.count = 0
+        self.not_modified = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'not_modified': self.not_modified,
+            'errors': self.errors,
+            'total_seconds': self.total_seconds,
+            'max_seconds': self.max_seconds,
+        }
+
+class GithubClient(object):
+    def __init__(self, user, repo, base_url, pool_size, etag_cache_size, token_path=ACCESS_TOKEN_PATH,
+                 rate_limit_reserve=0, rate_limit_max_wait=0):
+        self.user = user
+        self.repo = repo
+        self.base_url = base_url.rstrip('/')
+        self.token_path = token_path
+        # requests は読み込みに時間がかかるので、GitHub を使うときまで読み込まない
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # url -> (etag, data, size)
+        self._etags = LRUCache(etag_cache_size, sizeof=lambda value: value[2])
+        self._token = None
+        self._token_mtime = None
+        self._token_lock = threading.Lock()
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        # 種類 (CORE, SEARCH) -> RateLimit
+        self.rate_limits = {CORE: RateLimit(), SEARCH: RateLimit()}
+        self.rate_limit_reserve = rate_limit_reserve
+        self.rate_limit_max_wait = rate_limit_max_wait
+
+    def _get_token(self):
+        # ファイルが更新されたときだけ読み直す
+        mtime = os.stat(self.token_path).st_mtime
+        with self._token_lock:
+            if mtime != self._token_mtime:
+                self._token = open(self.token_path).read().strip()
+                self._token_mtime = mtime
+            return self._token
+
+    def _record(self, endpoint, seconds, status_code):
+        with self._stats_lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = _EndpointStats()
+            stats.count += 1
+            stats.total_seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            if status_code == 304:
+                stats.not_modified += 1
+            elif status_code >= 400:
+                stats.errors += 1
+
+    def request(self, method, endpoint, path, params=None, data=None, url=None, use_reserve=None):
+        """API を呼び出して、JSON をデコードした結果とレスポンスを返す
+
+        endpoint は統計を取るときの名前。url を指定した場合は path より優先する。
+        use_reserve が True なら取っておいた残りも使う（省略すると GET 以外は使う）。
+        """
+        if url is None:
+            url = '{base}/repos/{user}/{repo}/{path}'.format(
+                base=self.base_url, user=self.user, repo=self.repo, path=path)
+        resource = SEARCH if url.startswith(self.base_url + '/search/') else CORE
+        headers = {
+            'Accept': 'application/vnd.github.v3+json',
+            'Authorization': 'token ' + self._get_token(),
+        }
+        cache_key = None
+        cached = None
+        if method == 'GET':
+            cache_key = url + '?' + '&'.join('{0}={1}'.format(k, v) for k, v in sorted((params or {}).items()))
+            cached = self._etags.get(cache_key)
+            if cached is not None:
+                headers['If-None-Match'] = cached[0]
+
+        # ページの読み出しは issue の更新のために残りを取っておく
+        # (304 なら回数に数えられないが、返ってくるまで分からない)
+        if use_reserve is None:
+            use_reserve = method != 'GET'
+        reserve = 0 if use_reserve else self.rate_limit_reserve
+        self.rate_limits[resource].check(reserve, self.rate_limit_max_wait)
+
+        start = time.time()
+        response = self.session.request(method, url, params=params, json=data, headers=headers)
+        self._record(endpoint, time.time() - start, response.status_code)
+        # どの種類の残りなのかはヘッダで分かる
+        rate_limit = self.rate_limits.get(response.headers.get('X-RateLimit-Resource', resource))
+        if rate_limit is None:
+            rate_limit = self.rate_limits[resource]
+        rate_limit.update(response)
+
+        if response.status_code == 304 and cached is not None:
+            return cached[1], response
+        if self._is_rate_limited(response):
+            reset_at = self._reset_at(response)
+            rate_limit.exhausted(reset_at)
+            raise RateLimitExceeded(reset_at, response.text)
+        if response.status_code >= 400:
+            raise GithubError(response.status_code, response.text)
+
+        result = response.json() if response.content else None
+        etag = response.headers.get('ETag')
+        if cache_key is not None and etag:
+            self._etags.set(cache_key, (etag, result, len(response.content)))
+        return result, response
+
+    def _is_rate_limited(self, response):
+        if response.status_code == 429:
+            return True
+        # 二次的な制限は Retry-After だけが付いてくる
+        return response.status_code == 403 and (
+            response.headers.get('X-RateLimit-Remaining') == '0' or 'Retry-After' in response.headers)
+
+    def _reset_at(self, response):
+        if 'Retry-After' in response.headers:
+            try:
+                return time.time() + int(response.headers['Retry-After'])
+            except ValueError:
+                pass
+        try:
+            return float(response.headers['X-RateLimit-Reset'])
+        except (KeyError, ValueError):
+            return time.time() + 60
+
+    def _get(self, endpoint, path, **params):
+        return self.request('GET', endpoint, path, params=params or None)[0]
+
+    def get_ref(self, ref):
+        return self._get('git/refs', 'git/refs/' + ref)
+
+    def get_tree(self, sha, recursive=False):
+        if recursive:
+            return self._get('git/trees', 'git/trees/' + sha, recursive=1)
+        return self._get('git/trees', 'git/trees/' + sha)
+
+    def get_blob(self, sha):
+        return self._get('git/blobs', 'git/blobs/' + sha)
+
+    def get_issue(self, number):
+        return self.request('GET', 'issues', 'issues/{number}'.format(number=number), use_reserve=True)[0]
+
+    def search_issues(self, query):
+        """タイトルなどで issue を検索する。query に repo: は自動で付ける"""
+        url = '{base}/search/issues'.format(base=self.base_url)
+        params = {'q': '{query} repo:{user}/{repo} type:issue'.format(query=query, user=self.user, repo=self.repo)}
+        return self.request('GET', 'search/issues', None, params=params, url=url, use_reserve=True)[0]['items']
+
+    def create_issue(self, data):
+        return self.request('POST', 'issues', 'issues', data=data)[0]
+
+    def update_issue(self, number, data):
+        return self.request('PATCH', 'issues', 'issues/{number}'.format(number=number), data=data)[0]
+
+    def stats(self):
+        with self._stats_lock:
+            endpoints = dict((name, stats.to_dict()) for name, stats in self._stats.items())
+        return {
+            'endpoints': endpoints,
+            'etag_cache': self._etags.stats(),
+            'rate_limits': dict((resource, rate_limit.to_dict()) for resource, rate_limit in self.rate_limits.items()),
+        }
+
+# (user, repo) -> GithubClient
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(user, repo):
+    with _clients_lock:
+        client = _clients.get((user, repo))
+        if client is None:
+            client = _clients[(user, repo)] = GithubClient(
+                user=user,
+                repo=repo,
+                base_url=settings.GITHUB_API_URL,
+                pool_size=settings.GITHUB_POOL_SIZE,
+                etag_cache_size=settings.GITHUB_ETAG_CACHE_SIZE,
+                rate_limit_reserve=settings.GITHUB_RATE_LIMIT_RESERVE,
+                rate_limit_max_wait=settings.GITHUB_RATE_LIMIT_MAX_WAIT)
+        return client
+
+def get_stats():
+    with _clients_lock:
+        clients = _clients.items()
+    return dict(('{0}/{1}'.format(*key), client.stats()) for key, client in clients)
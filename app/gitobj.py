@@ -0,0 +1,139 @@
+#coding: utf-8
+"""
+作業ツリーを触らずに git のオブジェクトを直接読む
+
+`git cat-file --batch` を起動したままにしておき、パイプ越しに問い合わせる。
+リクエストごとにプロセスを起動しないし、checkout もしないので、
+他のリクエストが checkout している最中でも安全に読める。
+"""
+import os
+import threading
+import subprocess
+from collections import namedtuple
+from django.conf import settings
+from app import metrics
+
+ObjectInfo = namedtuple('ObjectInfo', ['sha', 'type', 'size'])
+Object = namedtuple('Object', ['sha', 'type', 'size', 'data'])
+
+class GitObjectError(Exception):
+    pass
+
+class CatFile(object):
+    """起動したままの `git cat-file --batch` (または `--batch-check`)"""
+
+    def __init__(self, git_dir, batch_check=False):
+        self.git_dir = git_dir
+        self.option = '--batch-check' if batch_check else '--batch'
+        self._process = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._process = subprocess.Popen(
+            ['git', 'cat-file', self.option],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=self.git_dir)
+
+    def _query(self, rev):
+        if self._process is None or self._process.poll() is not None:
+            self._start()
+        stdin, stdout = self._process.stdin, self._process.stdout
+        stdin.write(rev + '\n')
+        stdin.flush()
+        header = stdout.readline()
+        if not header:
+            raise IOError('git cat-file exited unexpectedly')
+        fields = header.split()
+        # "<rev> missing" や "<rev> ambiguous" が返ってくる
+        if len(fields) != 3:
+            return None
+        sha, type, size = fields[0], fields[1], int(fields[2])
+        if self.option == '--batch-check':
+            return ObjectInfo(sha, type, size)
+        data = stdout.read(size)
+        stdout.read(1)  # 末尾の改行
+        return Object(sha, type, size, data)
+
+    def query(self, rev):
+        if '\n' in rev:
+            raise GitObjectError('invalid revision: {rev!r}'.format(rev=rev))
+        with self._lock, metrics.timer('git'):
+            try:
+                return self._query(rev)
+            except (IOError, OSError):
+                # プロセスが死んでいたら一度だけ起動し直す
+                self.close()
+                return self._query(rev)
+
+    def close(self):
+        process, self._process = self._process, None
+        if process is None:
+            return
+        try:
+            process.stdin.close()
+            process.wait()
+        except (IOError, OSError):
+            pass
+
+class Repository(object):
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self._batch = CatFile(git_dir)
+        self._batch_check = CatFile(git_dir, batch_check=True)
+
+    def info(self, rev):
+        """オブジェクトの SHA、種類、サイズを返す。存在しなければ None"""
+        return self._batch_check.query(rev)
+
+    def read(self, rev):
+        """オブジェクトの中身を返す。存在しなければ None"""
+        return self._batch.query(rev)
+
+    def resolve(self, rev):
+        """ブランチ名などをコミットの SHA にする"""
+        info = self.info(rev + '^{commit}')
+        if info is None:
+            raise GitObjectError('unknown revision: {rev}'.format(rev=rev))
+        return info.sha
+
+    def ls_tree(self, rev):
+        """rev 以下の全ての blob を (blob の SHA, パス) のリストで返す"""
+        with metrics.timer('git'):
+            output = subprocess.check_output(['git', 'ls-tree', '-r', '-z', rev], cwd=self.git_dir)
+        entries = []
+        for line in output.split('\0'):
+            if not line:
+                continue
+            meta, path = line.split('\t', 1)
+            mode, type, sha = meta.split(' ')
+            if type == 'blob':
+                entries.append((sha, path))
+        return entries
+
+    def diff_tree(self, old, new):
+        """二つのコミットの間で変わったファイルを (A/M/D などの状態, パス) のリストで返す"""
+        with metrics.timer('git'):
+            output = subprocess.check_output(['git', 'diff-tree', '-r', '--name-status', '-z', old, new], cwd=self.git_dir)
+        fields = output.split('\0')
+        return [(fields[i], fields[i + 1]) for i in range(0, len(fields) - 1, 2)]
+
+    def close(self):
+        self._batch.close()
+        self._batch_check.close()
+
+_repository = None
+_repository_pid = None
+_repository_lock = threading.Lock()
+
+def get_repository():
+    """settings.GIT_DIR のリポジトリを返す
+
+    fork した子プロセスでは親のパイプを共有しないように作り直す。
+    """
+    global _repository, _repository_pid
+    with _repository_lock:
+        if _repository is None or _repository_pid != os.getpid():
+            _repository = Repository(settings.GIT_DIR)
+            _repository_pid = os.getpid()
+        return _repository
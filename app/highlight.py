@@ -0,0 +1,49 @@
+#coding: utf-8
+"""
+Pygments によるコードのハイライト結果をキャッシュする
+
+cpprefjp のページはほとんどが C++ のサンプルコードで、同じようなコードが
+何百ページにも出てくる。codehilite の CodeHilite.hilite を差し替えて、
+(言語, コードのハッシュ, 整形の設定) が同じなら前回の結果を返す。
+"""
+import hashlib
+from markdown.extensions import codehilite
+from app.cache import LRUCache
+from app import metrics
+
+_original_hilite = codehilite.CodeHilite.hilite
+_cache = None
+
+def _cache_key(hilite):
+    src = hilite.src.strip('\n')
+    if isinstance(src, unicode):
+        src = src.encode('utf-8')
+    return (
+        hilite.lang,
+        hilite.guess_lang,
+        hilite.linenums,
+        hilite.css_class,
+        hilite.style,
+        hilite.noclasses,
+        hilite.tab_length,
+        hashlib.sha1(src).hexdigest(),
+    )
+
+def _cached_hilite(self):
+    with metrics.timer('highlight'):
+        key = _cache_key(self)
+        html = _cache.get(key)
+        if html is None:
+            html = _original_hilite(self)
+            _cache.set(key, html)
+        return html
+
+def install(max_size):
+    """CodeHilite にキャッシュを差し込む。何度呼んでも一度しか差し込まない"""
+    global _cache
+    if _cache is None:
+        _cache = LRUCache(max_size)
+        codehilite.CodeHilite.hilite = _cached_hilite
+
+def stats():
+    return _cache.stats() if _cache is not None else None
@@ -0,0 +1,322 @@
+#coding: utf-8
+"""
+リポジトリを書き換える git の操作を、リクエストとは別のスレッドで順番に実行する
+
+ジョブはプロセスごとに一つのスレッドで順番に実行する。実行中は GIT_DIR の下の
+ファイルのロックを取るので、ワーカープロセスが複数あっても /start と /commit の
+checkout や merge が混ざることはない。リクエストはジョブの ID をすぐに返し、
+進み具合は /jobs/<id> で確認する。ジョブの状態は SQLite に保存するので、
+どのプロセスに問い合わせてもよい。
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+import traceback
+import subprocess
+import Queue
+from django.conf import settings
+from app.sharedcache import SQLiteConnections, SingleFlight
+from app import models
+from app import workers
+from app import gitobj
+from app import validation
+
+class Job(object):
+    def __init__(self, name, func, store):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.func = func
+        self.state = 'queued'
+        self.output = []
+        self.error = None
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._store = store
+        self._save()
+
+    def _save(self):
+        self._store.save(self)
+
+    def log(self, message):
+        print>>sys.stdout, message
+        sys.stdout.flush()
+        self.output.append(message)
+        self._save()
+
+    def run(self, lock=True):
+        if not lock:
+            return self._run()
+        # 他のプロセスのジョブとも混ざらないように、リポジトリのロックを取ってから動かす
+        with _get_repository_lock().hold('jobs'):
+            self._run()
+
+    def _run(self):
+        self.state = 'running'
+        self.started_at = time.time()
+        self._save()
+        try:
+            self.result = self.func(self)
+            self.state = 'succeeded'
+        except subprocess.CalledProcessError as e:
+            self.log(e.output)
+            self.error = str(e)
+            self.state = 'failed'
+        except Exception:
+            self.error = traceback.format_exc()
+            self.state = 'failed'
+        self.finished_at = time.time()
+        self._save()
+
+    def to_dict(self):
+        return _job_dict(self.id, self.name, self.state, self.output, self.error, self.result,
+                         self.created_at, self.started_at, self.finished_at)
+
+def _job_dict(id, name, state, output, error, result, created_at, started_at, finished_at):
+    end = finished_at or time.time()
+    return {
+        'id': id,
+        'name': name,
+        'state': state,
+        'output': list(output),
+        'error': error,
+        'result': result,
+        'created_at': created_at,
+        'started_at': started_at,
+        'finished_at': finished_at,
+        'duration': end - started_at if started_at is not None else None,
+    }
+
+class JobStore(object):
+    """ジョブの状態を SQLite に保存して、どのプロセスからでも見られるようにする"""
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS jobs ('
+        ' id TEXT PRIMARY KEY,'
+        ' name TEXT NOT NULL,'
+        ' state TEXT NOT NULL,'
+        ' output TEXT NOT NULL,'
+        ' error TEXT,'
+        ' result TEXT,'
+        ' created_at REAL NOT NULL,'
+        ' started_at REAL,'
+        ' finished_at REAL)',
+        'CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at)',
+    )
+
+    def __init__(self, path, history, stale_after):
+        self.history = history
+        self.stale_after = stale_after
+        self._connections = SQLiteConnections(path, self.SCHEMA)
+
+    def save(self, job):
+        conn = self._connections.get()
+        conn.execute(
+            'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (job.id, job.name, job.state, json.dumps(job.output), job.error, json.dumps(job.result),
+             job.created_at, job.started_at, job.finished_at))
+        if job.state == 'queued':
+            # 古いジョブの記録は捨てる
+            conn.execute('DELETE FROM jobs WHERE id NOT IN (SELECT id FROM jobs ORDER BY created_at DESC LIMIT ?)',
+                         (self.history,))
+
+    def _to_dict(self, row):
+        id, name, state, output, error, result, created_at, started_at, finished_at = row
+        return _job_dict(id, name, state, json.loads(output), error, json.loads(result) if result is not None else None,
+                         created_at, started_at, finished_at)
+
+    def get(self, job_id):
+        row = self._connections.get().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+    def list(self):
+        rows = self._connections.get().execute('SELECT * FROM jobs ORDER BY created_at').fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def add_unless_active(self, name, create):
+        """まだ終わっていない name のジョブがあればその ID を返す。無ければ create() で作る
+
+        他のプロセスと同時に呼ばれても二つ作らないように、探すのと作るのを一つの
+        トランザクションで行う。stale_after 秒より前に作られたものは、
+        止まったプロセスが残したものとみなして数えない。
+        """
+        conn = self._connections.get()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE name = ? AND state IN ('queued', 'running') AND created_at > ?"
+                ' ORDER BY created_at DESC LIMIT 1', (name, time.time() - self.stale_after)).fetchone()
+            if row is not None:
+                return row[0], None
+            job = create()
+            return job.id, job
+
+    def latest(self, name):
+        """name の一番新しいジョブの状態を返す。無ければ None"""
+        row = self._connections.get().execute(
+            'SELECT * FROM jobs WHERE name = ? ORDER BY created_at DESC LIMIT 1', (name,)).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+_repository_lock = None
+
+def _get_repository_lock():
+    global _repository_lock
+    if _repository_lock is None:
+        _repository_lock = SingleFlight(os.path.join(settings.GIT_DIR, '.git', 'andare-locks'), stripes=1)
+    return _repository_lock
+
+class JobRunner(object):
+    """
+    ジョブを順番に実行する
+
+    ジョブの状態は JobStore に保存するので、/jobs/<id> はどのワーカープロセスに
+    届いても答えられる。lock が偽なら、ジョブはリポジトリのロックを取らずに動かす。
+    """
+
+    def __init__(self, store, name='andare-git-worker', lock=True):
+        self.store = store
+        self.lock = lock
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._work, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.run(self.lock)
+
+    def submit(self, name, func):
+        job = Job(name, func, self.store)
+        self._queue.put(job)
+        return job
+
+    def submit_once(self, name, func):
+        """name のジョブがまだ終わっていなければ足さずに、そのジョブの ID を返す
+
+        どのプロセスで足されたジョブでも同じように扱う。
+        """
+        job_id, job = self.store.add_unless_active(name, lambda: Job(name, func, self.store))
+        if job is not None:
+            self._queue.put(job)
+        return job_id
+
+    def get(self, job_id):
+        """ジョブの状態を辞書で返す。無ければ None"""
+        return self.store.get(job_id)
+
+    def list(self):
+        return self.store.list()
+
+_runner = None
+_validation_runner = None
+_runner_pid = None
+_runner_lock = threading.Lock()
+
+def _get_runners():
+    global _runner, _validation_runner, _runner_pid
+    with _runner_lock:
+        if _runner is None or _runner_pid != os.getpid():
+            store = JobStore(settings.JOB_STORE_PATH, settings.JOB_HISTORY, settings.JOB_STALE_AFTER)
+            _runner = JobRunner(store)
+            # 検査は時間がかかるので、git の操作のジョブを待たせないように別に順番に動かす
+            _validation_runner = JobRunner(store, name='andare-validate-worker', lock=False)
+            _runner_pid = os.getpid()
+        return _runner, _validation_runner
+
+def get_runner():
+    """git の操作をするジョブを動かす JobRunner"""
+    return _get_runners()[0]
+
+def get_validation_runner():
+    """validate のジョブを動かす JobRunner。リポジトリのロックは必要なところでだけ取る"""
+    return _get_runners()[1]
+
+def start_warm_up(paths):
+    """paths のページを裏で変換する
+
+    進み具合は warm_up という名前のジョブとして保存するので、/warmup はどのプロセスに
+    問い合わせてもよい。変換はジョブの順番とは関係なく、すぐに始める。
+    """
+    job = Job('warm_up', None, get_runner().store)
+    job.state = 'running'
+    job.started_at = time.time()
+
+    def report(status):
+        job.result = status
+        if status['state'] == 'done':
+            job.state = 'succeeded'
+            job.finished_at = status['finished_at']
+        job._save()
+    return workers.start_warm_up(paths, report)
+
+def get_warm_up_status():
+    job = get_runner().store.latest('warm_up')
+    if job is None or job['result'] is None:
+        return {'state': 'idle'}
+    return job['result']
+
+def start(job):
+    """origin/master を取ってきて fetched ブランチにマージする"""
+    job.log(models.git_fetch(settings.GIT_REMOTE))
+    repo = gitobj.get_repository()
+    # 取ってきた origin/master が GitHub の HEAD なので、/view はそれを使う
+    models.set_github_head(repo.resolve(settings.GIT_REMOTE_BRANCH))
+    models.git_checkout(settings.GIT_LOCAL_FETCHED)
+    old_sha = repo.resolve(settings.GIT_LOCAL_FETCHED)
+    message = models.git_merge(settings.GIT_REMOTE_BRANCH)
+    job.log(message)
+    # 追加・削除されたページにリンクしているページは、変換結果が変わるかもしれない
+    affected = models.invalidate_links(models._git_diff(old_sha, repo.resolve(settings.GIT_LOCAL_FETCHED)))
+    if affected:
+        job.log('links: {count} pages to re-render'.format(count=len(affected)))
+    # 更新されたページを裏で変換しておく
+    paths = models.get_update_paths()
+    start_warm_up(paths + [path for path in affected if path not in set(paths)])
+    return message
+
+def commit(job):
+    """fetched ブランチを master にマージする"""
+    models.resolve_errors()
+
+    # マージすると差分が無くなるので、先に更新されたページを調べておく
+    paths = models.get_update_paths()
+    models.git_checkout(settings.GIT_LOCAL_BRANCH)
+    message = models.git_merge(settings.GIT_LOCAL_FETCHED)
+    job.log(message)
+    models.git_checkout(settings.GIT_LOCAL_FETCHED)
+    start_warm_up(paths)
+    # master に入った差分だけ検索の索引を更新する
+    job.log('search index: {count} pages updated'.format(count=models.update_search_index()))
+    return message
+
+def update_search_index(job):
+    """master の内容で検索の索引を作り直す（索引が無いときに使う）"""
+    count = models.update_search_index()
+    job.log('search index: {count} pages updated'.format(count=count))
+    return count
+
+def validate(job, next_trigger_at):
+    """追加・更新されたページを全て変換してみて、エラーになったページを issue に書く
+
+    リポジトリのロックは、検査するコミットとページを決める間だけ持つ。
+    検査はコミットの SHA を指定して読むので、その間に /start や /commit が動いてもよい。
+    """
+    with _get_repository_lock().hold('jobs'):
+        commit_sha = models.resolve_snapshot()
+        paths = models.get_update_paths()
+        commit_id = models.get_commit_id(settings.GIT_LOCAL_BRANCH)
+    failures = validation.validate_pages(commit_sha, paths, settings.VALIDATE_PROCESSES, settings.VALIDATE_TIMEOUT)
+    for path, problems in sorted(failures.items()):
+        job.log('{path}: {problems}'.format(path=path, problems=', '.join(problems)))
+    job.log('validate: {failed} of {count} pages failed'.format(failed=len(failures), count=len(paths)))
+    if failures:
+        models.register_errors(sorted(failures), next_trigger_at, commit_id)
+    return {
+        'pages': len(paths),
+        'errors': failures,
+    }
@@ -0,0 +1,146 @@
+#coding: utf-8
+"""
+ページ間のリンクの索引
+
+html_attribute はリンクをページのパスから書き換えるので、変換結果はリンク先の
+ページが追加されたり削除されたりしても変わりうる。変換したページのリンク先を
+保存しておき、リンク先 -> リンク元 を引けるようにして、変わったページに
+リンクしているページだけを変換し直す。
+
+ページごとに epoch を持ち、変換結果のキーに含める。リンク先が増減したら
+リンク元の epoch を上げて、古い変換結果を使わないようにする。
+epoch はリクエストごとに引くので、プロセスごとにメモリに読み込んでおき、
+他のプロセスが上げたことは隣に置いたファイル (GENERATION_SUFFIX) が置き換わったことで知る。
+"""
+import os
+import re
+import time
+import posixpath
+import itertools
+import threading
+from app.sharedcache import SQLiteConnections
+from app.fileutil import write_atomic
+
+GENERATION_SUFFIX = '.generation'
+
+_INLINE_LINK_RE = re.compile(r'\]\(\s*<?([^)\s>]+)')
+_REFERENCE_LINK_RE = re.compile(r'^ {0,3}\[[^\]]+\]:\s*<?([^\s>]+)', re.MULTILINE)
+_SCHEME_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*:|//)')
+
+def extract_links(path, md):
+    """Markdown の md から、サイト内へのリンク先をリポジトリ内のパスにして返す
+
+    >>> extract_links('reference/vector/push_back.md',
+    ...               '[a](/reference/vector.md) [b](insert.md#note) [c](http://example.com/)\\n'
+    ...               '[d](../map.md)\\n[e]: /reference/string.md "title"\\n[f](#top)')
+    ['reference/map.md', 'reference/string.md', 'reference/vector.md', 'reference/vector/insert.md']
+    """
+    base = posixpath.dirname(path)
+    targets = set()
+    for match in itertools.chain(_INLINE_LINK_RE.finditer(md), _REFERENCE_LINK_RE.finditer(md)):
+        target = match.group(1)
+        if _SCHEME_RE.match(target):
+            continue
+        target = target.split('#', 1)[0].split('?', 1)[0]
+        if not target:
+            continue
+        if target.startswith('/'):
+            target = target.lstrip('/')
+        else:
+            target = posixpath.join(base, target)
+        target = posixpath.normpath(target)
+        if target.startswith('..') or target == '.':
+            continue
+        targets.add(target)
+    return sorted(targets)
+
+class LinkIndex(object):
+    """リンクの索引とページごとの epoch を SQLite に保存する
+
+    複数のプロセスから同時に読み書きできる。
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS links ('
+        ' source TEXT NOT NULL,'
+        ' target TEXT NOT NULL,'
+        ' PRIMARY KEY (source, target))',
+        'CREATE INDEX IF NOT EXISTS links_target ON links (target)',
+        'CREATE TABLE IF NOT EXISTS epochs ('
+        ' path TEXT PRIMARY KEY,'
+        ' epoch INTEGER NOT NULL)',
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self._connections = SQLiteConnections(path, self.SCHEMA)
+        self._generation_path = path + GENERATION_SUFFIX
+        # パス -> epoch。0 のものは入っていない
+        self._epochs = None
+        self._epochs_generation = None
+        self._epochs_lock = threading.Lock()
+
+    def _connection(self):
+        conn = self._connections.get()
+        # パスは str で扱う
+        conn.text_factory = str
+        return conn
+
+    def set_links(self, source, targets):
+        conn = self._connection()
+        current = set(row[0] for row in conn.execute('SELECT target FROM links WHERE source = ?', (source,)))
+        if current == set(targets):
+            return
+        with conn:
+            conn.execute('BEGIN')
+            conn.execute('DELETE FROM links WHERE source = ?', (source,))
+            conn.executemany('INSERT INTO links (source, target) VALUES (?, ?)',
+                             [(source, target) for target in targets])
+
+    def remove_source(self, source):
+        self._connection().execute('DELETE FROM links WHERE source = ?', (source,))
+
+    def linking_to(self, targets):
+        """targets のどれかにリンクしているページを返す"""
+        conn = self._connection()
+        sources = set()
+        for target in targets:
+            sources.update(row[0] for row in conn.execute('SELECT source FROM links WHERE target = ?', (target,)))
+        return sources
+
+    def all_links(self):
+        """{リンク先: [リンク元]} を返す"""
+        result = {}
+        for source, target in self._connection().execute('SELECT source, target FROM links ORDER BY target, source'):
+            result.setdefault(target, []).append(source)
+        return result
+
+    def source_count(self):
+        return self._connection().execute('SELECT COUNT(DISTINCT source) FROM links').fetchone()[0]
+
+    def _generation(self):
+        try:
+            st = os.stat(self._generation_path)
+        except OSError:
+            return None
+        # 置き換えるたびに別のファイルになる
+        return st.st_ino, st.st_mtime
+
+    def epoch(self, path):
+        generation = self._generation()
+        with self._epochs_lock:
+            if self._epochs is None or generation != self._epochs_generation:
+                self._epochs = dict(self._connection().execute('SELECT path, epoch FROM epochs'))
+                self._epochs_generation = generation
+            return self._epochs.get(path, 0)
+
+    def bump(self, paths):
+        """paths の epoch を上げて、今までの変換結果を使わないようにする"""
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN')
+            for path in paths:
+                conn.execute('INSERT OR IGNORE INTO epochs (path, epoch) VALUES (?, 0)', (path,))
+                conn.execute('UPDATE epochs SET epoch = epoch + 1 WHERE path = ?', (path,))
+        # 他のプロセスに読み直してもらう
+        write_atomic(self._generation_path, repr(time.time()))
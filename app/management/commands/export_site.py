@@ -0,0 +1,99 @@
+#coding: utf-8
+import os
+import json
+import time
+import multiprocessing
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.template.loader import render_to_string
+from app import models
+from app.fileutil import write_atomic
+
+MANIFEST_NAME = '.manifest.json'
+
+def _output_path(output_dir, path):
+    return os.path.join(output_dir, *path[:-len('.md')].split('/')) + '.html'
+
+def _export_page(args):
+    sha, path, output_dir = args
+    start = time.time()
+    paths = path.split('/')
+    try:
+        content = models.render_blob(paths, models.get_blob_by_sha(sha))
+        html = render_to_string('app/markdown_to_html.html', content)
+        write_atomic(_output_path(output_dir, path), html.encode('utf-8'))
+    except Exception as e:
+        return path, None, time.time() - start, '{name}: {message}'.format(name=type(e).__name__, message=e)
+    return path, models.get_etag(paths, sha), time.time() - start, None
+
+class Command(BaseCommand):
+    args = '<output_dir>'
+    help = 'Render every page of the fetched branch into static html files under output_dir'
+    option_list = BaseCommand.option_list + (
+        make_option('--rev', default=settings.GIT_LOCAL_FETCHED,
+                    help='branch or commit to export'),
+        make_option('--processes', type='int', default=multiprocessing.cpu_count(),
+                    help='number of worker processes'),
+        make_option('--slowest', type='int', default=10,
+                    help='number of slowest pages to report'),
+        make_option('--force', action='store_true', default=False,
+                    help='export every page even if unchanged'),
+    )
+
+    def handle(self, output_dir=None, **options):
+        if output_dir is None:
+            raise CommandError('output_dir is required')
+        manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        manifest = {}
+        if os.path.exists(manifest_path) and not options['force']:
+            manifest = json.load(open(manifest_path))
+
+        pages = models.list_pages(options['rev'])
+        # blob の SHA（と変換器のバージョン）が前回と同じページは飛ばす
+        targets = [(sha, path, output_dir) for sha, path in pages
+                   if manifest.get(path) != models.get_etag(path.split('/'), sha)
+                   or not os.path.exists(_output_path(output_dir, path))]
+
+        # 無くなったページは消す
+        existing = set(path for _, path in pages)
+        for path in list(manifest):
+            if path not in existing:
+                try:
+                    os.remove(_output_path(output_dir, path))
+                except OSError:
+                    pass
+                del manifest[path]
+
+        self.stdout.write('{total} pages, {count} to export'.format(total=len(pages), count=len(targets)))
+        start = time.time()
+        timings = []
+        errors = []
+        pool = multiprocessing.Pool(options['processes'])
+        try:
+            for path, etag, seconds, error in pool.imap_unordered(_export_page, targets, chunksize=8):
+                timings.append((seconds, path))
+                if error is None:
+                    manifest[path] = etag
+                else:
+                    errors.append((path, error))
+                    manifest.pop(path, None)
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - start
+
+        write_atomic(manifest_path, json.dumps(manifest, indent=1, sort_keys=True))
+
+        self.stdout.write('exported {count} pages in {elapsed:.2f}s ({rate:.1f} pages/s)'.format(
+            count=len(timings) - len(errors),
+            elapsed=elapsed,
+            rate=len(timings) / elapsed if elapsed > 0 else 0.0))
+        if timings:
+            self.stdout.write('slowest pages:')
+            for seconds, path in sorted(timings, reverse=True)[:options['slowest']]:
+                self.stdout.write('  {ms:8.1f} ms  {path}'.format(ms=seconds * 1000, path=path))
+        for path, error in errors:
+            self.stderr.write('failed: {path}: {error}'.format(path=path, error=error))
+        if errors:
+            raise CommandError('{count} pages failed'.format(count=len(errors)))
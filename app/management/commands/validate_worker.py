@@ -0,0 +1,14 @@
+#coding: utf-8
+import os
+import sys
+from django.core.management.base import BaseCommand
+from app import validation
+
+class Command(BaseCommand):
+    help = 'Check pages sent one JSON line at a time on stdin (started by /validate, not meant to be run by hand)'
+
+    def handle(self, *args, **options):
+        # 標準出力はやりとりに使うので、print などの出力は標準エラーに回す
+        output = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        validation.serve(sys.stdin, output)
@@ -0,0 +1,158 @@
+#coding: utf-8
+"""
+処理の段階ごとの所要時間を計測する
+
+    with metrics.timer('markdown'):
+        ...
+
+と書くと、その段階の所要時間がヒストグラムに集計され、リクエストの途中であれば
+Server-Timing ヘッダにも出力される。集計結果は /metrics で Prometheus の
+テキスト形式で返す。
+"""
+import time
+import threading
+import contextlib
+from collections import OrderedDict
+
+# ヒストグラムの区切り（秒）
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+# (メトリクスの名前, ラベルの値) -> Histogram
+_histograms = {}
+_histograms_lock = threading.Lock()
+_help = {
+    'andare_stage_duration_seconds': 'Time spent in each processing stage',
+    'andare_request_duration_seconds': 'Time spent handling each request, by view',
+}
+_label_names = {
+    'andare_stage_duration_seconds': 'stage',
+    'andare_request_duration_seconds': 'view',
+}
+
+def observe(name, label, seconds):
+    with _histograms_lock:
+        histogram = _histograms.get((name, label))
+        if histogram is None:
+            histogram = _histograms[(name, label)] = Histogram()
+        histogram.observe(seconds)
+
+_local = threading.local()
+
+def start_request():
+    # 段階の名前 -> [合計時間, 回数]
+    _local.stages = OrderedDict()
+
+def finish_request():
+    stages = getattr(_local, 'stages', None)
+    _local.stages = None
+    return stages or OrderedDict()
+
+def record(stage, seconds):
+    observe('andare_stage_duration_seconds', stage, seconds)
+    stages = getattr(_local, 'stages', None)
+    if stages is not None:
+        entry = stages.setdefault(stage, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+
+@contextlib.contextmanager
+def timer(stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(stage, time.time() - start)
+
+def server_timing(stages):
+    """Server-Timing ヘッダの値を作る（dur はミリ秒）"""
+    return ', '.join('{stage};dur={ms:.2f};desc="{count}x"'.format(stage=stage, ms=seconds * 1000, count=count)
+                     for stage, (seconds, count) in stages.items())
+
+# 集計した値を返す関数のリスト
+_collectors = []
+
+def register_collector(collector):
+    """/metrics に出す値を返す関数を登録する
+
+    collector は (名前, 種類, 説明, {ラベル: 値}, 値) のリストを返す。
+    """
+    _collectors.append(collector)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + '}'
+
+def format_prometheus():
+    lines = []
+    with _histograms_lock:
+        histograms = sorted((key, (list(h.cumulative()), h.count, h.sum)) for key, h in _histograms.items())
+    last_name = None
+    for (name, label), (buckets, count, total) in histograms:
+        if name != last_name:
+            lines.append('# HELP {name} {help}'.format(name=name, help=_help.get(name, name)))
+            lines.append('# TYPE {name} histogram'.format(name=name))
+            last_name = name
+        label_name = _label_names.get(name, 'label')
+        for bound, cumulative in buckets:
+            lines.append('{name}_bucket{labels} {value}'.format(
+                name=name, labels=_format_labels({label_name: label, 'le': bound}), value=cumulative))
+        lines.append('{name}_bucket{labels} {value}'.format(
+            name=name, labels=_format_labels({label_name: label, 'le': '+Inf'}), value=count))
+        lines.append('{name}_sum{labels} {value}'.format(name=name, labels=_format_labels({label_name: label}), value=total))
+        lines.append('{name}_count{labels} {value}'.format(name=name, labels=_format_labels({label_name: label}), value=count))
+
+    samples = []
+    for collector in _collectors:
+        samples.extend(collector())
+    described = set()
+    for name, type, help, labels, value in sorted(samples, key=lambda sample: sample[0]):
+        if name not in described:
+            lines.append('# HELP {name} {help}'.format(name=name, help=help))
+            lines.append('# TYPE {name} {type}'.format(name=name, type=type))
+            described.add(name)
+        lines.append('{name}{labels} {value}'.format(name=name, labels=_format_labels(labels), value=value))
+    return '\n'.join(lines) + '\n'
+
+class MetricsMiddleware(object):
+    """リクエストごとに段階ごとの所要時間を集めて、Server-Timing ヘッダに出す"""
+
+    def process_request(self, request):
+        start_request()
+        request._metrics_started_at = time.time()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_view = getattr(view_func, '__name__', 'unknown')
+
+    def process_response(self, request, response):
+        stages = finish_request()
+        started_at = getattr(request, '_metrics_started_at', None)
+        if started_at is not None:
+            seconds = time.time() - started_at
+            observe('andare_request_duration_seconds', getattr(request, '_metrics_view', 'unknown'), seconds)
+            stages['total'] = [seconds, 1]
+        if stages:
+            response['Server-Timing'] = server_timing(stages)
+        return response
@@ -1,64 +1,207 @@
 #coding: utf-8
 import os
 import json
+import time
 import datetime
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import re
+import bisect
+import threading
 import subprocess
+import errno
 from django.conf import settings
-import requests
-from pygithub3 import Github
-from pygithub3.core.client import Client
 import markdown
+import pygments
+from app.cache import LRUCache, DiskCache, RenderCache, make_key
+from app.fileutil import write_atomic
+from app.sharedcache import SQLiteCache, SingleFlight
+from app.converter import ConverterPool
+from app import highlight
+from app import compress
+from app import search
+from app import links
+from app import gitobj
+from app import github
+from app import metrics
 
 BASE_URL = 'https://sites.google.com/site/cpprefjp'
 TARGET_GITHUB_USER = 'cpprefjp'
 TARGET_GITHUB_REPO = 'site'
+TARGET_GITHUB_BRANCH = 'master'
+
+# 変換結果が変わるような修正（拡張やテンプレートの更新など）を入れたら、この値を上げること
+RENDERER_REVISION = 1
+RENDERER_VERSION = '{revision}/markdown-{markdown}/pygments-{pygments}'.format(
+    revision=RENDERER_REVISION,
+    markdown=markdown.version,
+    pygments=pygments.__version__,
+)
+
+# ページによって変わらない拡張
+MARKDOWN_EXTENSIONS = [
+    'tables',
+    'markdown_to_html.qualified_fenced_code',
+    'codehilite(noclasses=True)',
+]
+
+_converter_pool = ConverterPool(MARKDOWN_EXTENSIONS)
+highlight.install(settings.HIGHLIGHT_CACHE_SIZE)
+
+def _page_extensions(paths):
+    """ページごとに設定の変わる拡張"""
+    return [
+        ('markdown_to_html.html_attribute', [
+            ('base_url', BASE_URL),
+            ('base_path', '/'.join(paths[:-1])),
+            ('full_path', '/'.join(paths)),
+        ]),
+        ('markdown_to_html.footer', [
+            ('url', 'https://github.com/cpprefjp/site/edit/master/{paths}'.format(
+                paths='/'.join(paths),
+            )),
+        ]),
+    ]
 
 def _md_to_html(md_data, paths):
-    qualified_fenced_code = 'markdown_to_html.qualified_fenced_code'
-    html_attribute = 'markdown_to_html.html_attribute(base_url={base_url}, base_path={base_path}, full_path={full_path})'.format(
-        base_url=BASE_URL,
-        base_path='/'.join(paths[:-1]),
-        full_path='/'.join(paths),
-    )
-    footer = 'markdown_to_html.footer(url={url})'.format(
-        url='https://github.com/cpprefjp/site/edit/master/{paths}'.format(
-            paths='/'.join(paths),
-        )
-    )
-
-    md = markdown.Markdown([
-        'tables',
-        qualified_fenced_code,
-        'codehilite(noclasses=True)',
-        html_attribute,
-        footer])
-    return md.convert(unicode(md_data, encoding='utf-8'))
-
-def _get_tree_by_path(trees, sha, path):
-    result = trees.get(sha)
-    for tree in result.tree:
+    return _converter_pool.convert(unicode(md_data, encoding='utf-8'), _page_extensions(paths))
+
+def _get_github():
+    return github.get_client(TARGET_GITHUB_USER, TARGET_GITHUB_REPO)
+
+def _get_tree_by_path(gh, sha, path):
+    result = gh.get_tree(sha)
+    for tree in result['tree']:
         if tree['path'] == path:
             return tree
 
-def _get_file_from_path(paths):
-    access_token = open('.access_token').read()
-    gh = Github(user=TARGET_GITHUB_USER, repo=TARGET_GITHUB_REPO, token=access_token)
+# sha は blob の SHA、read はファイルの中身を返す関数
+Blob = namedtuple('Blob', ['sha', 'read'])
+
+# コミットの SHA -> {パス: blob の SHA}
+_path_indexes = OrderedDict()
+_path_indexes_lock = threading.Lock()
+_path_index_single_flight = SingleFlight()
+# いくつのコミット分の索引を持っておくか
+PATH_INDEX_COUNT = 4
 
-    sha = 'HEAD'
+def _get_path_index(gh, commit_sha):
+    """コミット内の全ファイルのパスから blob の SHA を引く辞書を返す
+
+    ツリーは再帰的に一回で取得して、コミットごとに覚えておく。
+    ツリーが大きすぎて切り詰められていた場合は None を返す。
+    """
+    with _path_indexes_lock:
+        index = _path_indexes.get(commit_sha)
+    if index is not None:
+        return index
+
+    # HEAD が動いた直後に同時に来たリクエストは、一つの取得を待ち合わせる
+    with _path_index_single_flight.hold(commit_sha):
+        with _path_indexes_lock:
+            index = _path_indexes.get(commit_sha)
+        if index is None:
+            index = _fetch_path_index(gh, commit_sha)
+    return index
+
+def _fetch_path_index(gh, commit_sha):
+    result = gh.get_tree(commit_sha, recursive=True)
+    if result.get('truncated'):
+        return None
+    index = dict((tree['path'], tree['sha']) for tree in result['tree'] if tree['type'] == 'blob')
+
+    with _path_indexes_lock:
+        _path_indexes[commit_sha] = index
+        while len(_path_indexes) > PATH_INDEX_COUNT:
+            _path_indexes.popitem(last=False)
+    return index
+
+# (HEAD のコミットの SHA, 取得した時刻)
+_github_head = (None, 0)
+_github_head_lock = threading.Lock()
+
+def set_github_head(commit_sha):
+    """GitHub の HEAD が commit_sha だと分かったときに覚えておく"""
+    global _github_head
+    with _github_head_lock:
+        _github_head = (commit_sha, time.time())
+
+def _get_github_head(gh):
+    """GitHub の HEAD のコミットの SHA を返す
+
+    ページを表示するたびに参照を取得しないように、GITHUB_HEAD_TTL 秒の間は前回のものを使う。
+    """
+    with _github_head_lock:
+        commit_sha, fetched_at = _github_head
+    if commit_sha is not None and time.time() - fetched_at < settings.GITHUB_HEAD_TTL:
+        return commit_sha
+    commit_sha = gh.get_ref('heads/' + TARGET_GITHUB_BRANCH)['object']['sha']
+    set_github_head(commit_sha)
+    return commit_sha
+
+def _resolve_blob_sha(gh, paths):
+    commit_sha = _get_github_head(gh)
+    index = _get_path_index(gh, commit_sha)
+    if index is not None:
+        path = '/'.join(paths)
+        if path not in index:
+            raise IOError(errno.ENOENT, 'No such file', path)
+        return index[path]
+
+    sha = commit_sha
     for path in paths:
-        tree = _get_tree_by_path(gh.git_data.trees, sha, path)
+        tree = _get_tree_by_path(gh, sha, path)
         sha = tree['sha']
     assert tree['type'] == 'blob'
+    return sha
 
-    blob = gh.git_data.blobs.get(sha)
-    return blob.content.decode(encoding=blob.encoding)
+def _get_file_from_path(paths):
+    gh = _get_github()
+    with metrics.timer('tree_resolve'):
+        sha = _resolve_blob_sha(gh, paths)
+
+    def read():
+        # SHA が同じなら中身も同じなので、手元にあれば API を使わずに読む
+        obj = gitobj.get_repository().read(sha)
+        if obj is not None and obj.type == 'blob':
+            return obj.data
+        blob = gh.get_blob(sha)
+        return blob['content'].decode(blob['encoding'])
+    return Blob(sha, read)
+
+# (コミットの SHA, パス) から引いた blob の SHA をいくつ覚えておくか
+SNAPSHOT_BLOB_COUNT = 4096
+
+# コミットが同じなら中身も変わらないので、消さなくてよい
+_snapshot_blobs = LRUCache(SNAPSHOT_BLOB_COUNT, sizeof=lambda value: 1)
+
+def resolve_snapshot(rev=None):
+    """rev (省略すると fetched ブランチ) をコミットの SHA にする
+
+    一度のリクエストで読むページは、ここで決めたコミットから読む。
+    途中で fetched ブランチが動いても、別のコミットのページが混ざらない。
+    """
+    return gitobj.get_repository().resolve(rev or settings.GIT_LOCAL_FETCHED)
+
+def get_blob_at(commit_sha, paths):
+    """checkout せずに commit_sha のコミットのファイルを直接読む"""
+    path = '/'.join(paths)
+    sha = _snapshot_blobs.get((commit_sha, path))
+    if sha is None:
+        rev = '{commit}:{path}'.format(commit=commit_sha, path=path)
+        with metrics.timer('tree_resolve'):
+            info = gitobj.get_repository().info(rev)
+        if info is None or info.type != 'blob':
+            raise IOError(errno.ENOENT, 'No such file', rev)
+        sha = info.sha
+        _snapshot_blobs.set((commit_sha, path), sha)
+    return get_blob_by_sha(sha)
 
 def _get_file_from_path_local(paths):
-    git_checkout(settings.GIT_LOCAL_FETCHED)
-    path = os.path.join(settings.GIT_DIR, *paths)
-    return open(path).read()
+    return get_blob_at(resolve_snapshot(), paths)
+
+def get_blob_by_sha(sha):
+    repo = gitobj.get_repository()
+    return Blob(sha, lambda: repo.read(sha).data)
 
 _HASH_HEADER_RE = re.compile(r'^( *?\n)*#(?P<header>.*?)#*(\n|$)(?P<remain>(.|\n)*)', re.MULTILINE)
 _SETEXT_HEADER_RE = re.compile(r'^( *?\n)*(?P<header>.*?)\n=+[ ]*(\n|$)(?P<remain>(.|\n)*)', re.MULTILINE)
@@ -96,43 +239,169 @@ def _split_title(md):
         return None, md
     return m.group('header').strip(), m.group('remain')
 
-def _get_html_content(paths, get_file):
-    md = get_file(paths)
-    title, md = _split_title(md)
+_render_cache = None
+_render_single_flight = None
+
+def get_render_cache():
+    global _render_cache
+    if _render_cache is None:
+        shared = None
+        directory = settings.RENDER_CACHE_DIR
+        if directory is not None:
+            if settings.RENDER_CACHE_BACKEND == 'sqlite':
+                shared = SQLiteCache(os.path.join(directory, 'render.sqlite3'), settings.RENDER_CACHE_DISK_SIZE)
+            else:
+                shared = DiskCache(directory, settings.RENDER_CACHE_DISK_SIZE)
+        _render_cache = RenderCache(settings.RENDER_CACHE_MEMORY_SIZE, shared)
+    return _render_cache
+
+def _get_render_single_flight():
+    global _render_single_flight
+    if _render_single_flight is None:
+        directory = settings.RENDER_CACHE_DIR
+        _render_single_flight = SingleFlight(os.path.join(directory, 'locks') if directory is not None else None)
+    return _render_single_flight
+
+def _render(paths, md):
+    with metrics.timer('split_title'):
+        title, md = _split_title(md)
     if title is None:
         title = paths[-1].split('.')[0]
+    with metrics.timer('markdown'):
+        html = _md_to_html(md, paths)
     return {
         'title': title,
-        'html': _md_to_html(md, paths),
+        'html': html,
     }
 
-def get_latest_html_content_by_path(paths):
-    return _get_html_content(paths, _get_file_from_path)
+_link_index = None
+
+def get_link_index():
+    global _link_index
+    if _link_index is None:
+        _link_index = links.LinkIndex(settings.LINK_INDEX_PATH)
+    return _link_index
+
+def _render_key(paths, sha):
+    path = '/'.join(paths)
+    # リンク先のページが増減したら epoch が上がって、変換し直すことになる
+    epoch = get_link_index().epoch(path)
+    return make_key(sha, RENDERER_VERSION, path, str(epoch))
+
+def render_blob(paths, blob):
+    cache = get_render_cache()
+    key = _render_key(paths, blob.sha)
+    content = cache.get(key)
+    if content is None:
+        # 同じページを他のスレッドやプロセスが変換していたら、それを待って結果を使う
+        with _get_render_single_flight().hold(key):
+            content = cache.get(key)
+            if content is None:
+                with metrics.timer('fetch'):
+                    md = blob.read()
+                content = _render(paths, md)
+                cache.set(key, content)
+                path = '/'.join(paths)
+                get_link_index().set_links(path, links.extract_links(path, md))
+    return content
+
+def get_etag(paths, sha):
+    """変換結果が変わるときだけ変わる ETag（引用符なし）を返す"""
+    return _render_key(paths, sha)
+
+def _response_key(etag, representation, encoding):
+    return make_key(etag, representation, encoding)
+
+def get_precompressed_response(etag, representation, encoding):
+    """store_precompressed_responses で保存したレスポンスの本体を返す。無ければ None"""
+    return get_render_cache().get_raw(_response_key(etag, representation, encoding))
+
+def store_precompressed_responses(etag, representation, body):
+    """レスポンスの本体を圧縮して、エンコーディングごとに保存する
+
+    representation は同じページの表し方（テンプレートなど）を区別する文字列。
+    {エンコーディング: 本体} を返す。
+    """
+    cache = get_render_cache()
+    with metrics.timer('compress'):
+        variants = compress.compress_all(body, settings.PRECOMPRESS_ENCODINGS, settings.PRECOMPRESS_MIN_SIZE)
+    for encoding in [compress.IDENTITY] + compress.available(settings.PRECOMPRESS_ENCODINGS):
+        # 圧縮しなかったエンコーディングは、そのままのものを返すように空で覚えておく
+        cache.set_raw(_response_key(etag, representation, encoding), variants.get(encoding, ''))
+    return variants
+
+def render_path(path, commit_sha=None):
+    """commit_sha (省略すると fetched ブランチ) のページを変換して、ETag と一緒に返す"""
+    paths = path.strip('/').split('/')
+    blob = get_blob_by_path(paths, commit_sha)
+    content = render_blob(paths, blob)
+    return {
+        'path': path,
+        'etag': get_etag(paths, blob.sha),
+        'title': content['title'],
+        'html': content['html'],
+    }
 
-def get_html_content_by_path(paths):
-    return _get_html_content(paths, _get_file_from_path_local)
+# API の残りが無くて fetched ブランチで代わりに返した回数
+_github_fallbacks = 0
+
+def _get_file_from_path_or_local(paths):
+    """GitHub の HEAD を返す。API の残りが無ければ fetched ブランチのものを返す"""
+    global _github_fallbacks
+    try:
+        return _get_file_from_path(paths)
+    except github.RateLimitExceeded:
+        _github_fallbacks += 1
+        return _get_file_from_path_local(paths)
+
+def get_latest_blob_by_path(paths):
+    return _get_file_from_path_or_local(paths)
+
+def get_blob_by_path(paths, commit_sha=None):
+    if commit_sha is None:
+        return _get_file_from_path_local(paths)
+    return get_blob_at(commit_sha, paths)
 
 
 DiffType = namedtuple('DiffType', ['command', 'path'])
 
-def _git_diff():
-    output = subprocess.check_output(['git', 'diff', '--name-status', settings.GIT_LOCAL_BRANCH, settings.GIT_REMOTE_BRANCH], cwd=settings.GIT_DIR)
-    output = output.strip()
-    if len(output) == 0:
-        return []
+# いくつのコミット（の組）分の差分やファイル一覧を覚えておくか
+CONTENTS_CACHE_COUNT = 16
+
+# コミットの SHA から計算した結果を覚えておく。中身は書き換えないこと
+_contents_cache = LRUCache(CONTENTS_CACHE_COUNT, sizeof=lambda value: 1)
 
-    lines = output.split('\n')
-    return [DiffType(*t.split('\t')) for t in lines]
+def _memoize(key, func):
+    value = _contents_cache.get(key)
+    if value is None:
+        value = func()
+        _contents_cache.set(key, value)
+    return value
 
-def _diff_all():
-    git_checkout(settings.GIT_LOCAL_FETCHED)
-    output = subprocess.check_output(['git', 'ls-files'], cwd=settings.GIT_DIR)
-    output = output.strip()
-    if len(output) == 0:
-        return []
+def _branch_shas():
+    repo = gitobj.get_repository()
+    return repo.resolve(settings.GIT_LOCAL_BRANCH), repo.resolve(settings.GIT_REMOTE_BRANCH)
 
-    paths = output.split('\n')
-    return [DiffType(command='M', path=path) for path in paths]
+def _git_diff(local_sha=None, remote_sha=None):
+    if local_sha is None:
+        local_sha, remote_sha = _branch_shas()
+
+    def diff():
+        # 種類の変更 (T) は更新として扱う
+        return [DiffType('M' if command == 'T' else command, path)
+                for command, path in gitobj.get_repository().diff_tree(local_sha, remote_sha)]
+    return _memoize(('diff', local_sha, remote_sha), diff)
+
+def _diff_all(sha=None):
+    if sha is None:
+        sha = gitobj.get_repository().resolve(settings.GIT_LOCAL_FETCHED)
+
+    def diff():
+        return [DiffType(command='M', path=path) for _, path in gitobj.get_repository().ls_tree(sha)]
+    return _memoize(('all', sha), diff)
+
+def _is_ignored(filename):
+    return re.match('^([A-Z].*)|(.*!(\.md))$', filename) is not None
 
 def _diff_to_contents(diff_type_list):
     contents = { }
@@ -150,7 +419,7 @@ def _diff_to_contents(diff_type_list):
     for dt in diff_type_list:
         paths = dt.path.split('/')
         # 更新対象でないファイルは無視する
-        if re.match('^([A-Z].*)|(.*!(\.md))$', paths[-1]):
+        if _is_ignored(paths[-1]):
             continue
 
         dic = contents
@@ -235,80 +504,367 @@ def get_update_contents():
     ...     DiffType('D', 'ignored.if_extension_is_not_md')]
     >>> _diff_to_contents(files)
     {'file1.md': {'command': 'update', 'type': 'file', 'name': 'file1', 'path': 'file1.md'}, 'dir1.md': {'command': 'update', 'type': 'file', 'name': 'dir1', 'path': 'dir1.md'}, 'dir1': {'type': 'directory', 'name': 'dir1', 'children': {'file2.md': {'command': 'update', 'type': 'file', 'name': 'file2', 'path': 'dir1/file2.md'}, 'file3.md': {'command': 'delete', 'type': 'file', 'name': 'file3', 'path': 'dir1/file3.md'}}}, 'file2.md': {'command': 'append', 'type': 'file', 'name': 'file2', 'path': 'file2.md'}, 'ignored.if_extension_is_not_md': {'command': 'delete', 'type': 'file', 'name': 'ignored', 'path': 'ignored.if_extension_is_not_md'}}
+
+    作業ツリーは使わずにコミット同士を比べるので、両方のブランチが
+    前回と同じコミットを指していれば前回の結果をそのまま返す。
+    """
+    local_sha, remote_sha = _branch_shas()
+    return _memoize(('update_contents', local_sha, remote_sha),
+                    lambda: _diff_to_contents(_git_diff(local_sha, remote_sha)))
+
+def list_pages(rev):
+    """rev に含まれる変換対象のファイルを (blob の SHA, パス) のリストで返す"""
+    return [(sha, path) for sha, path in gitobj.get_repository().ls_tree(rev)
+            if path.endswith('.md') and not _is_ignored(path.split('/')[-1])]
+
+def get_update_paths(commands=('A', 'M')):
+    """origin/master との差分のうち、commands に含まれる変換対象のファイルのパスを返す"""
+    return [dt.path for dt in _git_diff()
+            if dt.command in commands and dt.path.endswith('.md') and not _is_ignored(dt.path.split('/')[-1])]
+
+_search_index = None
+_search_single_flight = None
+
+def get_search_index():
+    global _search_index
+    if _search_index is None:
+        _search_index = search.SearchIndex(settings.SEARCH_INDEX_DIR)
+    return _search_index
+
+def update_search_index(rev=None):
+    """rev (省略すると master) の内容に全文検索の索引を合わせて、読み直したページ数を返す
+
+    前回の索引を作ったコミットとの差分のページだけを読み直す。
+    索引がまだ無ければ全てのページを読む。
+    """
+    global _search_single_flight
+    if _search_single_flight is None:
+        _search_single_flight = SingleFlight(os.path.join(settings.SEARCH_INDEX_DIR, 'locks'))
+    repo = gitobj.get_repository()
+    sha = repo.resolve(rev or settings.GIT_LOCAL_BRANCH)
+    # 索引を書き換えるのは同時に一つだけ
+    with _search_single_flight.hold('update'):
+        writer = search.IndexWriter(settings.SEARCH_INDEX_DIR)
+        if writer.sha == sha:
+            return 0
+        if writer.sha is None:
+            changes = [DiffType('A', path) for _, path in list_pages(sha)]
+        else:
+            changes = _git_diff(writer.sha, sha)
+
+        count = 0
+        for dt in changes:
+            if not dt.path.endswith('.md') or _is_ignored(dt.path.split('/')[-1]):
+                continue
+            obj = repo.read('{sha}:{path}'.format(sha=sha, path=dt.path)) if dt.command != 'D' else None
+            if obj is None:
+                writer.remove(dt.path)
+            else:
+                title, md = _split_title(obj.data)
+                if title is None:
+                    title = dt.path.split('/')[-1].split('.')[0]
+                writer.add(dt.path, title, md)
+            count += 1
+        writer.write(sha)
+    return count
+
+def search_pages(query, limit=20):
+    """全文検索して [{path, title, score}] を返す。索引がまだ無ければ None"""
+    with metrics.timer('search'):
+        results = get_search_index().search(query, limit)
+    if results is None:
+        return None
+    return [{'path': path, 'title': title, 'score': score} for path, title, score in results]
+
+def invalidate_links(diff_type_list):
+    """追加・削除されたページにリンクしているページの変換結果を捨てて、そのパスを返す"""
+    index = get_link_index()
+    changed = [dt.path for dt in diff_type_list if dt.command in ('A', 'D')]
+    for dt in diff_type_list:
+        if dt.command == 'D':
+            # 削除されたページのリンクは使われないので消しておく
+            index.remove_source(dt.path)
+    affected = sorted(index.linking_to(changed) - set(changed))
+    index.bump(affected)
+    return affected
+
+def get_broken_links(rev=None):
+    """rev (省略すると fetched) に無いページへのリンクを返す
+
+    変換したことのあるページのリンクだけが対象になる。
     """
-    return _diff_to_contents(_git_diff())
+    sha = gitobj.get_repository().resolve(rev or settings.GIT_LOCAL_FETCHED)
+    paths = set(dt.path for dt in _diff_all(sha))
+    index = get_link_index()
+    broken = []
+    for target, sources in sorted(index.all_links().items()):
+        sources = [source for source in sources if source in paths]
+        if target not in paths and sources:
+            broken.append({'path': target, 'linked_from': sources})
+    return {
+        'pages_indexed': index.source_count(),
+        'broken': broken,
+    }
+
+def get_stats():
+    return {
+        'render_cache': get_render_cache().stats(),
+        'render_single_flight': _get_render_single_flight().stats(),
+        'highlight_cache': highlight.stats(),
+        'converters': _converter_pool.stats(),
+        'snapshot_blobs': _snapshot_blobs.stats(),
+        'github': github.get_stats(),
+        'github_fallbacks': _github_fallbacks,
+    }
+
+def _collect_metrics():
+    samples = []
+    def cache_samples(name, stats):
+        if stats is None:
+            return
+        for key in ('hits', 'misses', 'evictions'):
+            samples.append(('andare_cache_{0}_total'.format(key), 'counter',
+                            'Cache {0}'.format(key), {'cache': name}, stats[key]))
+        samples.append(('andare_cache_size_bytes', 'gauge', 'Bytes held by the cache', {'cache': name}, stats['size']))
+
+    render_cache = get_render_cache().stats()
+    cache_samples('render_memory', render_cache['memory'])
+    cache_samples('render_shared', render_cache['shared'])
+    cache_samples('highlight', highlight.stats())
+    samples.append(('andare_single_flight_waits_total', 'counter',
+                    'Requests that waited for another worker to render the same page', {},
+                    _get_render_single_flight().stats()['waits']))
+    for repo, stats in github.get_stats().items():
+        for endpoint, endpoint_stats in stats['endpoints'].items():
+            labels = {'repo': repo, 'endpoint': endpoint}
+            samples.append(('andare_github_requests_total', 'counter', 'GitHub API requests', labels, endpoint_stats['count']))
+            samples.append(('andare_github_not_modified_total', 'counter', 'GitHub API requests answered with 304', labels, endpoint_stats['not_modified']))
+            samples.append(('andare_github_errors_total', 'counter', 'GitHub API requests that failed', labels, endpoint_stats['errors']))
+            samples.append(('andare_github_request_seconds_total', 'counter', 'Time spent in GitHub API requests', labels, endpoint_stats['total_seconds']))
+        for resource, rate_limit in stats['rate_limits'].items():
+            labels = {'repo': repo, 'resource': resource}
+            if rate_limit['remaining'] is not None:
+                samples.append(('andare_github_rate_limit_remaining', 'gauge', 'GitHub API requests left in the current window', labels, rate_limit['remaining']))
+                samples.append(('andare_github_rate_limit_reset_seconds', 'gauge', 'Seconds until the GitHub API budget resets', labels, max(0, rate_limit['reset_at'] - time.time())))
+            if rate_limit['limit'] is not None:
+                samples.append(('andare_github_rate_limit', 'gauge', 'GitHub API requests allowed per window', labels, rate_limit['limit']))
+            samples.append(('andare_github_rate_limited_total', 'counter', 'GitHub API requests refused to save the budget', labels, rate_limit['limited']))
+    samples.append(('andare_github_fallbacks_total', 'counter', 'Pages served from the fetched branch because the GitHub API budget ran out', {}, _github_fallbacks))
+    return samples
+
+metrics.register_collector(_collect_metrics)
 
 def get_all_contents():
-    return _diff_to_contents(_diff_all())
+    sha = gitobj.get_repository().resolve(settings.GIT_LOCAL_FETCHED)
+    return _memoize(('all_contents', sha), lambda: _diff_to_contents(_diff_all(sha)))
+
+def _collapse_paths(paths, prefix, depth):
+    """prefix 以下のパスのうち、prefix から depth 階層より深いものをディレクトリにまとめる
+
+    まとめたディレクトリは末尾に '/' を付けて返す。
+
+    >>> paths = ['a.md', 'a/b.md', 'a/b/c.md', 'a/b/d.md', 'a/e.md', 'b.md']
+    >>> _collapse_paths(paths, None, None)
+    ['a.md', 'a/b.md', 'a/b/c.md', 'a/b/d.md', 'a/e.md', 'b.md']
+    >>> _collapse_paths(paths, 'a', None)
+    ['a/b.md', 'a/b/c.md', 'a/b/d.md', 'a/e.md']
+    >>> _collapse_paths(paths, 'a', 1)
+    ['a/b.md', 'a/b/', 'a/e.md']
+    >>> _collapse_paths(paths, None, 1)
+    ['a.md', 'a/', 'b.md']
+    """
+    if prefix:
+        prefix = prefix.strip('/') + '/'
+        # ソート済みなので prefix 以下の範囲は二分探索で求まる
+        # ('0' は '/' の次の文字)
+        paths = paths[bisect.bisect_left(paths, prefix):bisect.bisect_left(paths, prefix[:-1] + '0')]
+    if depth is None:
+        return paths
+    base = prefix.count('/') if prefix else 0
+    items = set()
+    for path in paths:
+        segments = path.split('/')
+        if len(segments) > base + depth:
+            path = '/'.join(segments[:base + depth]) + '/'
+        items.add(path)
+    return sorted(items)
+
+def query_all_contents(prefix=None, depth=None, cursor=None, limit=None):
+    """get_all_contents() の一部だけを返す
+
+    prefix 以下のファイルだけにして、prefix から depth 階層より深いディレクトリは
+    中身を省略し "truncated": true を付ける。cursor には前回返した next_cursor を渡すと、
+    その続きから limit 個分を返す。続きが無ければ next_cursor は None になる。
+    """
+    sha = gitobj.get_repository().resolve(settings.GIT_LOCAL_FETCHED)
+
+    def page_paths():
+        return sorted(dt.path for dt in _diff_all(sha) if not _is_ignored(dt.path.split('/')[-1]))
+    items = _collapse_paths(_memoize(('page_paths', sha), page_paths), prefix, depth)
+
+    start = bisect.bisect_right(items, cursor) if cursor else 0
+    end = len(items) if limit is None else start + limit
+    page = items[start:end]
+    next_cursor = page[-1] if end < len(items) and page else None
+
+    contents = _diff_to_contents([DiffType('M', path) for path in page if not path.endswith('/')])
+    for path in page:
+        if not path.endswith('/'):
+            continue
+        dic = contents
+        for name in path.rstrip('/').split('/'):
+            if name not in dic:
+                dic[name] = {
+                    "type": "directory",
+                    "name": name.split('.')[0],
+                    "children": { },
+                }
+            node = dic[name]
+            dic = node["children"]
+        node["truncated"] = True
+    return contents, next_cursor
+
+def _git(*args):
+    with metrics.timer('git'):
+        return subprocess.check_output(('git',) + args, cwd=settings.GIT_DIR, stderr=subprocess.STDOUT)
 
 def git_fetch(branch):
-    return subprocess.check_output(['git', 'fetch', branch], cwd=settings.GIT_DIR)
+    return _git('fetch', branch)
 
 def git_checkout(branch):
-    return subprocess.check_output(['git', 'checkout', '-q', branch], cwd=settings.GIT_DIR)
+    return _git('checkout', '-q', branch)
 
 def git_merge(branch):
-    return subprocess.check_output(['git', 'merge', branch], cwd=settings.GIT_DIR)
+    return _git('merge', branch)
 
 def get_commit_id(branch):
-    git_checkout(branch)
-    return subprocess.check_output(['git', 'log', '-1', 'HEAD', '--pretty=format:%H'], cwd=settings.GIT_DIR)
+    return gitobj.get_repository().resolve(branch)
 
 TITLE_FORMAT = 'Update Error: {commit_id}'
 
-def resolve_errors():
-    commit_id = get_commit_id(settings.GIT_LOCAL_BRANCH)
+class IssueIndex(object):
+    """コミット ID からエラー報告の issue 番号を引く表を JSON ファイルに保存しておく
+
+    他のプロセスが書き込んだ分は、見つからなかったときにファイルが
+    更新されていれば読み直して使う。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._data = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path) as f:
+                self._data = json.load(f)
+        except (IOError, ValueError):
+            return
+        self._mtime = mtime
+
+    def get(self, commit_id):
+        with self._lock:
+            if commit_id not in self._data:
+                self._reload()
+            return self._data.get(commit_id)
+
+    def set(self, commit_id, number):
+        with self._lock:
+            self._reload()
+            if self._data.get(commit_id) == number:
+                return
+            self._data[commit_id] = number
+            write_atomic(self.path, json.dumps(self._data))
+            self._mtime = os.stat(self.path).st_mtime
+
+_issue_index = None
+
+def _get_issue_index():
+    global _issue_index
+    if _issue_index is None:
+        _issue_index = IssueIndex(settings.ISSUE_INDEX_PATH)
+    return _issue_index
+
+def _find_error_issue(gh, commit_id):
+    """commit_id のエラー報告の issue のうち、開いているものを返す。無ければ None
+
+    覚えておいた番号があればその issue だけを取得し、無ければタイトルで検索する。
+    どちらも API の呼び出しは一回で、issue がいくつあっても変わらない。
+    """
     title = TITLE_FORMAT.format(commit_id=commit_id)
+    index = _get_issue_index()
+    number = index.get(commit_id)
+    if number is not None:
+        try:
+            issue = gh.get_issue(number)
+        except github.GithubError as e:
+            if e.status_code != 404:
+                raise
+            issue = None
+        if issue is not None and issue['title'] == title:
+            return issue if issue['state'] == 'open' else None
+
+    for issue in gh.search_issues('"{title}" in:title state:open'.format(title=title)):
+        # 検索は部分一致なので、タイトルが同じものだけを使う
+        if issue['title'] == title:
+            index.set(commit_id, issue['number'])
+            return issue
+    return None
 
-    access_token = open('.access_token').read()
-    gh = Github(user=TARGET_GITHUB_USER, repo=TARGET_GITHUB_REPO, token=access_token)
-    issues = gh.issues.list_by_repo(milestone=None, assignee=None)
-    for issue in issues.all():
-        if title == issue.title:
-            # 自動で閉じる
-            body = (
-                '\n\n'
-                '---- Closed by andare ----\n'
-                '修正が確認されたので Close します。'
-            )
-            gh.issues.update(issue.number, {
-                'state': 'close',
-                'body': issue.body.encode('utf-8') + body,
-            })
-            break
-
-def register_errors(errors, next_trigger_at):
+def resolve_errors():
     commit_id = get_commit_id(settings.GIT_LOCAL_BRANCH)
+
+    gh = _get_github()
+    issue = _find_error_issue(gh, commit_id)
+    if issue is not None:
+        # 自動で閉じる
+        body = (
+            '\n\n'
+            '---- Closed by andare ----\n'
+            '修正が確認されたので Close します。'
+        )
+        gh.update_issue(issue['number'], {
+            'state': 'close',
+            'body': issue['body'].encode('utf-8') + body,
+        })
+
+def register_errors(errors, next_trigger_at, commit_id=None):
+    if commit_id is None:
+        commit_id = get_commit_id(settings.GIT_LOCAL_BRANCH)
     title = TITLE_FORMAT.format(commit_id=commit_id)
 
     urls = ['| [/{error}](/cpprefjp/site/blob/master/{error}) | [check_site](http://melpon.org/andare/view/{error}) |'.format(error=error) for error in errors]
 
-    access_token = open('.access_token').read()
-    gh = Github(user=TARGET_GITHUB_USER, repo=TARGET_GITHUB_REPO, token=access_token)
-    issues = gh.issues.list_by_repo(milestone=None, assignee=None)
-    for issue in issues.all():
-        if title == issue.title:
-            # 更新する
-            body = issue.body.encode('utf-8')
-            body += (
-                '\n\n'
-                '---- Updated At {date} ----\n'
-                'まだ修正されていないファイルがあります。\n'
-                '\n'
-                '|ファイル|チェックサイト|\n'
-                '|--------|--------------|\n'
-            ).format(date=datetime.datetime.now())
-            body += '\n'.join(urls)
-            body += (
-                '\n\n'
-                '次の自動実行は [{datetime}] に行われます。\n'
-            ).format(datetime=next_trigger_at)
-
-            gh.issues.update(issue.number, {
-                'title': issue.title,
-                'body': body,
-            })
-            break
+    gh = _get_github()
+    issue = _find_error_issue(gh, commit_id)
+    if issue is not None:
+        # 更新する
+        body = issue['body'].encode('utf-8')
+        body += (
+            '\n\n'
+            '---- Updated At {date} ----\n'
+            'まだ修正されていないファイルがあります。\n'
+            '\n'
+            '|ファイル|チェックサイト|\n'
+            '|--------|--------------|\n'
+        ).format(date=datetime.datetime.now())
+        body += '\n'.join(urls)
+        body += (
+            '\n\n'
+            '次の自動実行は [{datetime}] に行われます。\n'
+        ).format(datetime=next_trigger_at)
+
+        gh.update_issue(issue['number'], {
+            'title': issue['title'],
+            'body': body,
+        })
     else:
         body = (
             '自動更新に失敗しました。\n'
@@ -324,10 +880,11 @@ def register_errors(errors, next_trigger_at):
             '次の自動実行は [{datetime}] に行われます。\n'
         ).format(datetime=next_trigger_at)
         # 新規作成
-        gh.issues.create({
+        issue = gh.create_issue({
             'title': title,
             'body': body,
         })
+        _get_issue_index().set(commit_id, issue['number'])
 
 def set_access_token(code):
     headers = {'Accept': 'application/json'}
@@ -336,9 +893,10 @@ def set_access_token(code):
         'client_id': '5163f9957aabe66d2ce4',
         'client_secret': open('.client_secret').read()[:-1],
     }
+    import requests
     r = requests.post('https://github.com/login/oauth/access_token', data=data, headers=headers)
     access_token = json.loads(r.text.encode('utf-8'))['access_token']
-    open('.access_token', 'w').write(access_token)
+    open(github.ACCESS_TOKEN_PATH, 'w').write(access_token)
 
 if __name__ == '__main__':
     import doctest
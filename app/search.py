@@ -0,0 +1,301 @@
+#coding: utf-8
+"""
+サイト全体の全文検索の索引
+
+ページをパス、タイトル、見出し、コードブロック中の識別子、本文に分けて単語にし、
+単語 -> [(ページ, 重み)] の転置索引を作る。英数字は単語ごと、日本語は 2 文字ずつと 1 文字ずつに区切る。
+
+索引は一つのファイルにまとめて mmap で読むので、プロセスの起動時に全部を読み込む必要がない。
+ファイルの中身は次の通り（数値は全てリトルエンディアン）:
+
+    ヘッダ       MAGIC, VERSION, ページ数, 単語数, 各部分の開始位置
+    ページの表   ページ数 x (パスの位置, パスの長さ, タイトルの位置, タイトルの長さ)
+    単語の表     単語数 x (単語の位置, 単語の長さ, 転置リストの開始, 長さ)  単語の順にソート済み
+    転置リスト   ページ番号 (uint32) の配列と、重み (float32) の配列
+    文字列       UTF-8 の文字列を並べたもの
+
+更新するときは、前回の索引を作ったコミットとの差分のページだけを単語に分け直す。
+そのために、ページごとの単語と重みを別のファイル (FORWARD_NAME) に保存しておく。
+"""
+import os
+import re
+import math
+import mmap
+import array
+import struct
+import marshal
+import heapq
+import threading
+from app.fileutil import write_atomic
+
+MAGIC = 'ANDS'
+VERSION = 2
+INDEX_NAME = 'index.bin'
+FORWARD_NAME = 'forward.marshal'
+
+# パス、タイトル、見出し、コード中の識別子、本文の重み
+FIELD_WEIGHTS = {
+    'path': 4.0,
+    'title': 8.0,
+    'heading': 4.0,
+    'code': 2.0,
+    'body': 1.0,
+}
+
+_HEADER = struct.Struct('<4sIIIIIII')
+_DOC = struct.Struct('<IIII')
+_TERM = struct.Struct('<IIII')
+
+_WORD_RE = re.compile(ur'[0-9A-Za-z_]+')
+_CJK_RE = re.compile(ur'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f]+')
+_FENCE_RE = re.compile(r'^(```|~~~)')
+_HEADING_RE = re.compile(r'^#+\s*(.*?)\s*#*\s*$')
+
+def tokenize(text, query=False):
+    """text を検索用の単語に分ける
+
+    英数字の並びは小文字にして、'_' を含むものは分けたものも加える。
+    日本語は 2 文字ずつに区切り、1 文字で検索できるように 1 文字ずつのものも加える。
+    query が真なら検索語として分けるので、1 文字ずつのものは 1 文字だけの場合にしか作らない。
+
+    >>> tokenize(u'std::vector::push_back')
+    [u'std', u'vector', u'push_back', u'push', u'back']
+    >>> tokenize(u'\\u8981\\u7d20\\u3092')  # 要素を
+    [u'\\u8981\\u7d20', u'\\u7d20\\u3092', u'\\u8981', u'\\u7d20', u'\\u3092']
+    >>> tokenize(u'\\u8981\\u7d20\\u3092\\u8ffd\\u52a0\\u3059\\u308b', query=True)  # 要素を追加する
+    [u'\\u8981\\u7d20', u'\\u7d20\\u3092', u'\\u3092\\u8ffd', u'\\u8ffd\\u52a0', u'\\u52a0\\u3059', u'\\u3059\\u308b']
+    >>> tokenize(u'\\u5024', query=True)  # 値
+    [u'\\u5024']
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    tokens = []
+    for match in _WORD_RE.finditer(text):
+        word = match.group(0).lower()
+        tokens.append(word)
+        if '_' in word:
+            tokens.extend(part for part in word.split('_') if part)
+    for match in _CJK_RE.finditer(text):
+        run = match.group(0)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        if not query or len(run) == 1:
+            tokens.extend(run)
+    return tokens
+
+def split_fields(path, title, md):
+    """ページを {フィールド: テキストのリスト} に分ける"""
+    fields = {'path': [path], 'title': [title or ''], 'heading': [], 'code': [], 'body': []}
+    in_code = False
+    for line in md.split('\n'):
+        if _FENCE_RE.match(line):
+            in_code = not in_code
+            continue
+        if in_code:
+            fields['code'].append(line)
+            continue
+        match = _HEADING_RE.match(line)
+        if match:
+            fields['heading'].append(match.group(1))
+        else:
+            fields['body'].append(line)
+    return fields
+
+def weigh(path, title, md):
+    """ページの {単語: 重み} を返す"""
+    counts = {}
+    for field, texts in split_fields(path, title, md).items():
+        weight = FIELD_WEIGHTS[field]
+        for text in texts:
+            for token in tokenize(text):
+                counts[token] = counts.get(token, 0.0) + weight
+    # 何度も出てくる単語が強くなりすぎないようにする
+    return dict((token, 1.0 + math.log(count)) for token, count in counts.items())
+
+class IndexWriter(object):
+    """ページを足したり消したりして、索引のファイルを書き出す"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.sha = None
+        # パス -> (タイトル, {単語: 重み})
+        self.docs = {}
+        path = os.path.join(directory, FORWARD_NAME)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                state = marshal.load(f)
+            if state.get('version') == VERSION:
+                self.sha = state['sha']
+                self.docs = state['docs']
+
+    def add(self, path, title, md):
+        if isinstance(title, str):
+            title = title.decode('utf-8', 'replace')
+        self.docs[path] = (title or u'', weigh(path, title, md))
+
+    def remove(self, path):
+        self.docs.pop(path, None)
+
+    def write(self, sha):
+        """sha のコミットの索引として書き出す"""
+        paths = sorted(self.docs)
+        strings = []
+        offset = [0]
+        def add_string(value):
+            data = value.encode('utf-8') if isinstance(value, unicode) else value
+            position = offset[0]
+            strings.append(data)
+            offset[0] += len(data)
+            return position, len(data)
+
+        postings = {}
+        doc_table = []
+        for doc_id, path in enumerate(paths):
+            title, weights = self.docs[path]
+            doc_table.append(add_string(path) + add_string(title))
+            for token, weight in weights.items():
+                postings.setdefault(token, []).append((doc_id, weight))
+
+        term_table = []
+        doc_ids = array.array('I')
+        scores = array.array('f')
+        for token in sorted(postings, key=lambda token: token.encode('utf-8')):
+            entries = postings[token]
+            term_table.append(add_string(token) + (len(doc_ids), len(entries)))
+            doc_ids.extend(doc_id for doc_id, _ in entries)
+            scores.extend(weight for _, weight in entries)
+
+        docs_offset = _HEADER.size
+        terms_offset = docs_offset + _DOC.size * len(doc_table)
+        postings_offset = terms_offset + _TERM.size * len(term_table)
+        strings_offset = postings_offset + 8 * len(doc_ids)
+        parts = [_HEADER.pack(MAGIC, VERSION, len(doc_table), len(term_table),
+                              docs_offset, terms_offset, postings_offset, strings_offset)]
+        parts.extend(_DOC.pack(*entry) for entry in doc_table)
+        parts.extend(_TERM.pack(*entry) for entry in term_table)
+        if array.array('I').itemsize != 4 or doc_ids.itemsize != 4:
+            raise RuntimeError('uint32 array is not 4 bytes on this platform')
+        parts.append(doc_ids.tostring())
+        parts.append(scores.tostring())
+        parts.extend(strings)
+        # 先に索引を書き、forward には書き終わったコミットを記録する
+        write_atomic(os.path.join(self.directory, INDEX_NAME), ''.join(parts))
+        write_atomic(os.path.join(self.directory, FORWARD_NAME), marshal.dumps({'version': VERSION, 'sha': sha, 'docs': self.docs}))
+        self.sha = sha
+
+class IndexReader(object):
+    """mmap した索引のファイルを引く"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.doc_count, self.term_count,
+         self._docs, self._terms, self._postings, self._strings) = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a search index: {path}'.format(path=path))
+        self._total_postings = (self._strings - self._postings) // 8
+
+    def close(self):
+        self._mm.close()
+
+    def _string(self, position, length):
+        start = self._strings + position
+        return self._mm[start:start + length]
+
+    def _term(self, i):
+        return _TERM.unpack_from(self._mm, self._terms + _TERM.size * i)
+
+    def doc(self, doc_id):
+        path_pos, path_len, title_pos, title_len = _DOC.unpack_from(self._mm, self._docs + _DOC.size * doc_id)
+        return self._string(path_pos, path_len), self._string(title_pos, title_len).decode('utf-8')
+
+    def postings(self, token):
+        """token の (ページ番号の配列, 重みの配列) を返す。無ければ None"""
+        key = token.encode('utf-8')
+        lo, hi = 0, self.term_count
+        # 単語の表を二分探索する
+        while lo < hi:
+            mid = (lo + hi) // 2
+            position, length, start, count = self._term(mid)
+            term = self._string(position, length)
+            if term < key:
+                lo = mid + 1
+            elif term > key:
+                hi = mid
+            else:
+                doc_ids = array.array('I')
+                doc_ids.fromstring(self._mm[self._postings + 4 * start:self._postings + 4 * (start + count)])
+                weights = array.array('f')
+                scores_start = self._postings + 4 * self._total_postings
+                weights.fromstring(self._mm[scores_start + 4 * start:scores_start + 4 * (start + count)])
+                return doc_ids, weights
+        return None
+
+    def search(self, query, limit=20):
+        """query の単語を全て含むページを、点数の高い順に (パス, タイトル, 点数) で返す"""
+        tokens = sorted(set(tokenize(query, query=True)))
+        if not tokens:
+            return []
+        lists = []
+        for token in tokens:
+            found = self.postings(token)
+            if found is None:
+                return []
+            lists.append(found)
+        # 少ないものから絞り込む
+        lists.sort(key=lambda (doc_ids, _): len(doc_ids))
+        scores = None
+        for doc_ids, weights in lists:
+            idf = math.log(1.0 + float(self.doc_count) / len(doc_ids))
+            if scores is None:
+                scores = dict((doc_id, weight * idf) for doc_id, weight in zip(doc_ids, weights))
+                continue
+            next_scores = {}
+            for doc_id, weight in zip(doc_ids, weights):
+                if doc_id in scores:
+                    next_scores[doc_id] = scores[doc_id] + weight * idf
+            scores = next_scores
+            if not scores:
+                return []
+        best = heapq.nlargest(limit, scores.items(), key=lambda (doc_id, score): (score, -doc_id))
+        results = []
+        for doc_id, score in best:
+            path, title = self.doc(doc_id)
+            results.append((path, title, score))
+        return results
+
+class SearchIndex(object):
+    """プロセス内で共有する読み出し用の索引
+
+    他のプロセスがファイルを置き換えたら開き直す。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def reader(self):
+        path = os.path.join(self.directory, INDEX_NAME)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            reader = self._reader
+            if reader is None or (reader.stat.st_ino, reader.stat.st_mtime) != (st.st_ino, st.st_mtime):
+                try:
+                    reader = IndexReader(path)
+                except ValueError:
+                    # 古い形式の索引は、作り直されるまで無いものとして扱う
+                    return None
+                # 使っている最中のスレッドがいるかもしれないので、古いものは閉じずに捨てる
+                self._reader = reader
+            return reader
+
+    def search(self, query, limit=20):
+        reader = self.reader()
+        if reader is None:
+            return None
+        return reader.search(query, limit)
@@ -0,0 +1,181 @@
+#coding: utf-8
+"""
+複数のワーカープロセスで共有するキャッシュと、同じキーの計算をまとめる仕組み
+"""
+import os
+import time
+import zlib
+import fcntl
+import sqlite3
+import threading
+import contextlib
+from app.fileutil import makedirs
+
+# 使った時刻を更新する間隔（秒）
+ACCESSED_RESOLUTION = 60
+
+class SQLiteConnections(object):
+    """スレッドごとの sqlite3 の接続
+
+    sqlite3 の接続はスレッドやプロセスをまたいで使えないので、それぞれで開く。
+    開いたときに schema の文を順に実行する。
+    """
+
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self._local = threading.local()
+
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            makedirs(os.path.dirname(self.path))
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.schema:
+                conn.execute(statement)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+class SQLiteCache(object):
+    """SQLite のファイルに保存するキャッシュ
+
+    複数のプロセスから同時に読み書きできる。
+    合計サイズが max_size を超えたら、最後に使われたのが古いものから消していく。
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS entries ('
+        ' key TEXT PRIMARY KEY,'
+        ' value BLOB NOT NULL,'
+        ' size INTEGER NOT NULL,'
+        ' accessed REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)',
+    )
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._connections = SQLiteConnections(path, self.SCHEMA)
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        return self._connections.get()
+
+    def get(self, key, default=None):
+        conn = self._connection()
+        row = conn.execute('SELECT value, accessed FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        now = time.time()
+        # 読むたびに書き込むと遅いので、使った時刻はたまにしか更新しない
+        if now - row[1] > ACCESSED_RESOLUTION:
+            conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+        self.hits += 1
+        return str(row[0])
+
+    def set(self, key, data):
+        if len(data) > self.max_size:
+            return
+        conn = self._connection()
+        conn.execute(
+            'INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)',
+            (key, sqlite3.Binary(data), len(data), time.time()))
+        with self._lock:
+            if self._size is None:
+                self._size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            else:
+                self._size += len(data)
+            if self._size > self.max_size:
+                self._evict(conn)
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def _evict(self, conn):
+        # 他のプロセスも書き込んでいるので、ここで実際の合計を数え直す
+        size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        target = self.max_size * 9 // 10
+        if size > target:
+            rows = conn.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall()
+            keys = []
+            for key, entry_size in rows:
+                if size <= target:
+                    break
+                keys.append((key,))
+                size -= entry_size
+            conn.executemany('DELETE FROM entries WHERE key = ?', keys)
+            self.evictions += len(keys)
+        self._size = size
+
+    def stats(self):
+        return {
+            'size': self._size or 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+class SingleFlight(object):
+    """同じキーの計算を同時に一つしか走らせないためのロック
+
+    プロセス内ではキーごとのロックで、プロセス間では lock_dir 以下のファイルの
+    flock で待ち合わせる。ロックファイルはキーのハッシュで stripes 個に振り分ける。
+    lock_dir が None ならプロセス内だけで待ち合わせる。
+    """
+
+    def __init__(self, lock_dir=None, stripes=64):
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self.waits = 0
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _acquire_local(self, key):
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        if not entry[0].acquire(False):
+            self.waits += 1
+            entry[0].acquire()
+        return entry
+
+    def _release_local(self, key, entry):
+        entry[0].release()
+        with self._lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def _lock_file(self, key):
+        makedirs(self.lock_dir)
+        stripe = (zlib.crc32(key) & 0xffffffff) % self.stripes
+        return open(os.path.join(self.lock_dir, 'lock-{0:02d}'.format(stripe)), 'a')
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        entry = self._acquire_local(key)
+        try:
+            if self.lock_dir is None:
+                yield
+                return
+            with self._lock_file(key) as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        finally:
+            self._release_local(key, entry)
+
+    def stats(self):
+        return {'waits': self.waits}
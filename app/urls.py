@@ -3,12 +3,21 @@ from app import views
 
 urlpatterns = patterns('',
     url(r'^/html/(?P<paths>.*)$', views.JSONGithubToHtmlView.as_view()),
+    url(r'^/batch$', views.BatchGithubToHtmlView.as_view()),
     url(r'^/view/(?P<paths>.*)$', views.HtmlGithubToHtmlView.as_view()),
     url(r'^/local/(?P<paths>.*)$', views.HtmlLocalGithubToHtmlView.as_view()),
     url(r'^/contents$', views.ContentsView.as_view()),
     url(r'^/all_contents$', views.AllContentsView.as_view()),
     url(r'^/start$', views.StartView.as_view()),
     url(r'^/commit$', views.CommitView.as_view()),
+    url(r'^/jobs$', views.JobView.as_view()),
+    url(r'^/jobs/(?P<job_id>[0-9a-f]+)$', views.JobView.as_view()),
+    url(r'^/warmup$', views.WarmUpView.as_view()),
     url(r'^/errors$', views.ErrorView.as_view()),
+    url(r'^/validate$', views.ValidateView.as_view()),
     url(r'^/oauth$', views.OAuthView.as_view()),
+    url(r'^/search$', views.SearchView.as_view()),
+    url(r'^/broken_links$', views.BrokenLinksView.as_view()),
+    url(r'^/stats$', views.StatsView.as_view()),
+    url(r'^/metrics$', views.MetricsView.as_view()),
 )
@@ -0,0 +1,180 @@
+#coding: utf-8
+"""
+追加・更新されたページを別のプロセスで変換して、エラーになるページを探す
+
+変換で例外が出たものと、Markdown の書き方の問題 (LINT_RULES) が見つかったものをエラーにする。
+ワーカーは manage.py validate_worker で起動したプロセスで、パイプで一行ずつやりとりする。
+一つのページの変換が終わらなくても全体が止まらないように、ページごとに時間を区切り、
+時間内に終わらなかったワーカーのプロセスは殺して新しいものに入れ替える。
+"""
+import os
+import re
+import sys
+import json
+import time
+import select
+import subprocess
+from django.conf import settings
+from app import models
+
+_FENCE_RE = re.compile(r'^\s*(```|~~~)')
+
+def lint_title(paths, md):
+    """先頭に見出しが無い
+
+    >>> lint_title(['a.md'], '# vector\\nbody')
+    >>> lint_title(['a.md'], 'body')
+    'no title'
+    """
+    title, _ = models._split_title(md)
+    if title is None:
+        return 'no title'
+
+def lint_code_block(paths, md):
+    """閉じていないコードブロックがある
+
+    >>> lint_code_block(['a.md'], '```cpp\\nint x;\\n```')
+    >>> lint_code_block(['a.md'], '```cpp\\nint x;\\n')
+    'unclosed code block'
+    """
+    fences = sum(1 for line in md.split('\n') if _FENCE_RE.match(line))
+    if fences % 2 != 0:
+        return 'unclosed code block'
+
+LINT_RULES = [lint_title, lint_code_block]
+
+def check_page(commit_sha, path):
+    """commit_sha のコミットの path を変換してみて、問題のリストを返す"""
+    paths = path.split('/')
+    blob = models.get_blob_by_path(paths, commit_sha)
+    try:
+        models.render_blob(paths, blob)
+    except Exception as e:
+        return ['{name}: {message}'.format(name=type(e).__name__, message=e)]
+    md = blob.read()
+    return [problem for problem in (rule(paths, md) for rule in LINT_RULES) if problem]
+
+def serve(input, output):
+    """ワーカーのプロセスで、input から一行ずつ受け取ったページを検査して output に返す
+
+    一行が JSON の {"commit": コミットの SHA, "path": パス} で、
+    {"path": パス, "problems": [問題]} を一行で返す。input が閉じられたら終わる。
+    """
+    for line in iter(input.readline, ''):
+        task = json.loads(line)
+        try:
+            problems = check_page(task['commit'], task['path'])
+        except Exception as e:
+            problems = ['{name}: {message}'.format(name=type(e).__name__, message=e)]
+        output.write(json.dumps({'path': task['path'], 'problems': problems}) + '\n')
+        output.flush()
+
+class _Worker(object):
+    """一度に一つのページを検査するプロセス
+
+    WSGI のワーカーから fork すると、他のスレッドが持っていたロックを持ったままの
+    状態で子プロセスが始まってしまうので、manage.py validate_worker で新しく起動する。
+    """
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(settings.PROJECT_DIR, 'manage.py'), 'validate_worker'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        self.path = None
+        self.deadline = None
+        self._buffer = ''
+
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def assign(self, commit_sha, path, timeout):
+        self.path = path
+        self.deadline = time.time() + timeout
+        self.process.stdin.write(json.dumps({'commit': commit_sha, 'path': path}) + '\n')
+        self.process.stdin.flush()
+
+    def read(self):
+        """読めるだけ読んで、返ってきた問題のリストを返す。まだ一行揃っていなければ None
+
+        プロセスが終わっていたら EOFError にする。
+        """
+        data = os.read(self.fileno(), 64 * 1024)
+        if not data:
+            raise EOFError
+        self._buffer += data
+        if '\n' not in self._buffer:
+            return None
+        line, self._buffer = self._buffer.split('\n', 1)
+        return json.loads(line)['problems']
+
+    def kill(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        # 閉じれば serve が終わる
+        deadline = time.time() + 1
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+        if self.process.poll() is None:
+            self.kill()
+        else:
+            self.process.stdout.close()
+
+def validate_pages(commit_sha, paths, processes, timeout):
+    """commit_sha のコミットの paths を processes 個のプロセスで検査する
+
+    {パス: 問題のリスト} を、問題のあったページについてだけ返す。
+    timeout 秒以内に終わらなかったページもエラーにする。
+    """
+    pending = list(reversed(paths))
+    failures = {}
+    workers = [_Worker() for _ in range(min(processes, len(paths)))]
+    try:
+        while True:
+            for worker in workers:
+                if worker.path is None and pending:
+                    worker.assign(commit_sha, pending.pop(), timeout)
+            busy = [worker for worker in workers if worker.path is not None]
+            if not busy:
+                break
+            wait = max(0, min(worker.deadline for worker in busy) - time.time())
+            ready, _, _ = select.select(busy, [], [], wait)
+            for worker in busy:
+                path = worker.path
+                if worker in ready:
+                    try:
+                        problems = worker.read()
+                    except (EOFError, IOError, OSError, ValueError):
+                        problems = ['worker process died']
+                        worker.kill()
+                        workers[workers.index(worker)] = _Worker()
+                    if problems is None:
+                        continue
+                    worker.path = None
+                elif time.time() >= worker.deadline:
+                    # 止まったままのワーカーは殺して、入れ替える
+                    problems = ['timed out after {timeout} seconds'.format(timeout=timeout)]
+                    worker.kill()
+                    workers[workers.index(worker)] = _Worker()
+                else:
+                    continue
+                if problems:
+                    failures[path] = problems
+    finally:
+        for worker in workers:
+            worker.stop()
+    return failures
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,9 +1,19 @@
 #coding: utf-8
 import json
+import time
 from django.conf import settings
 from django.views.generic.base import View, TemplateView
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import parse_etags, quote_etag
+from django.utils.cache import patch_vary_headers
 from app import models
+from app import workers
+from app import jobs
+from app import metrics
+from app import github
+from app import compress
+from app import gitobj
+from app import boot
 
 class EchoMixin(object):
     def echo(self, message):
@@ -16,17 +26,39 @@ class JSONResponseMixin(object):
     A mixin that can be used to render a JSON response.
     """
     response_class = HttpResponse
+    # True にすると、JSON を少しずつ書き出す StreamingHttpResponse で返す
+    stream_json = False
+    stream_chunk_size = 16 * 1024
 
     def render_to_response(self, context, **response_kwargs):
         """
         Returns a JSON response, transforming 'context' to make the payload.
         """
         response_kwargs['content_type'] = 'application/json'
+        if self.stream_json:
+            return StreamingHttpResponse(
+                self.iter_context_as_json(context),
+                **response_kwargs
+            )
         return self.response_class(
             self.convert_context_to_json(context),
             **response_kwargs
         )
 
+    def iter_context_as_json(self, context):
+        "Encode the context incrementally, yielding chunks of about stream_chunk_size"
+        chunks = []
+        size = 0
+        for chunk in json.JSONEncoder().iterencode(context):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= self.stream_chunk_size:
+                yield ''.join(chunks)
+                chunks = []
+                size = 0
+        if chunks:
+            yield ''.join(chunks)
+
     def convert_context_to_json(self, context):
         "Convert the context dictionary into a JSON object"
         # Note: This is *EXTREMELY* naive; in reality, you'll need
@@ -36,12 +68,79 @@ class JSONResponseMixin(object):
         return json.dumps(context)
 
 class GithubToHtmlMixin(object):
-    def get_html_content(self, paths):
-        return models.get_html_content_by_path(paths)
+    # 保存しておいた圧縮済みのレスポンスを返すときの Content-Type
+    precompressed_content_type = 'text/html; charset=utf-8'
+
+    def parse_paths(self, paths):
+        return paths.strip('/').split('/')
+
+    def get_blob(self, paths):
+        return models.get_blob_by_path(paths)
+
+    def get_representation(self):
+        """同じページでもビューによって本体が変わるので、それを区別する文字列"""
+        return '{content_type} {template}'.format(
+            content_type=self.precompressed_content_type,
+            template=getattr(self, 'template_name', None) or '')
+
+    def get_precompressed(self, etag, encoding):
+        """保存しておいた (本体, エンコーディング) を返す。無ければ None"""
+        representation = self.get_representation()
+        body = models.get_precompressed_response(etag, representation, encoding)
+        if body == '':
+            # 圧縮しても小さくならなかったので、そのままのものを返す
+            encoding = compress.IDENTITY
+            body = models.get_precompressed_response(etag, representation, encoding)
+        if body is None:
+            return None
+        return body, encoding
+
+    def render_body(self, paths, blob, etag):
+        response = self.render_to_response(self.get_context_data(paths, blob))
+        if hasattr(response, 'render'):
+            with metrics.timer('template'):
+                response.render()
+        return models.store_precompressed_responses(etag, self.get_representation(), response.content)
 
-    def get_context_data(self, paths, **kwargs):
-        paths = paths.strip('/').split('/')
-        content = self.get_html_content(paths)
+    def get(self, request, paths, **kwargs):
+        paths = self.parse_paths(paths)
+        blob = self.get_blob(paths)
+        etag = models.get_etag(paths, blob.sha)
+        encoding = compress.choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''),
+                                            compress.available(settings.PRECOMPRESS_ENCODINGS))
+
+        # 変わっていなければ、変換もテンプレートの描画もせずに返す
+        # (圧縮したものの ETag は "<etag>-<エンコーディング>" になっている)
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        matched = None
+        if if_none_match:
+            if if_none_match.strip() == '*':
+                matched = etag
+            else:
+                matched = next((tag for tag in parse_etags(if_none_match) if tag.split('-', 1)[0] == etag), None)
+        if matched is not None:
+            response = HttpResponseNotModified()
+            response['ETag'] = quote_etag(matched)
+        else:
+            precompressed = self.get_precompressed(etag, encoding)
+            if precompressed is None:
+                variants = self.render_body(paths, blob, etag)
+                if encoding not in variants:
+                    encoding = compress.IDENTITY
+                precompressed = variants[encoding], encoding
+            body, encoding = precompressed
+            response = HttpResponse(body, content_type=self.precompressed_content_type)
+            if encoding == compress.IDENTITY:
+                response['ETag'] = quote_etag(etag)
+            else:
+                response['Content-Encoding'] = encoding
+                response['ETag'] = quote_etag('{etag}-{encoding}'.format(etag=etag, encoding=encoding))
+        patch_vary_headers(response, ('Accept-Encoding',))
+        response['Cache-Control'] = settings.PAGE_CACHE_CONTROL
+        return response
+
+    def get_context_data(self, paths, blob, **kwargs):
+        content = models.render_blob(paths, blob)
         # ignore kwargs
         context = {
             'title': content['title'],
@@ -50,17 +149,79 @@ class GithubToHtmlMixin(object):
         return context
 
 class JSONGithubToHtmlView(JSONResponseMixin, GithubToHtmlMixin, TemplateView):
-    pass
+    precompressed_content_type = 'application/json'
+
+def _render_path(path, commit_sha=None):
+    try:
+        return models.render_path(path, commit_sha)
+    except Exception as e:
+        # 一つ失敗しても全体は止めずに、その行にエラーを書く
+        return {
+            'path': path,
+            'error': '{name}: {message}'.format(name=type(e).__name__, message=e),
+        }
+
+class BatchGithubToHtmlView(View):
+    """
+    複数のページをまとめて変換して、終わった順に一行ずつ JSON で返す (NDJSON)
+
+    paths に JSON のリストでパスを渡すか、diff=1 で /contents の差分のうち
+    追加・更新されたページ全てを対象にする。
+    ref にブランチ名やコミットの SHA を渡すと、fetched ブランチの代わりにそこから読む。
+    """
+
+    def post(self, request, *args, **kwargs):
+        return self.render(request.POST)
+
+    def get(self, request, *args, **kwargs):
+        return self.render(request.GET)
+
+    def render(self, params):
+        if params.get('diff'):
+            paths = models.get_update_paths()
+        else:
+            paths = json.loads(params.get('paths', '[]'))
+        # 全てのページを同じコミットから読む
+        try:
+            commit_sha = models.resolve_snapshot(params.get('ref'))
+        except gitobj.GitObjectError:
+            raise Http404
+
+        results = workers.get_render_pool().imap_unordered(lambda path: _render_path(path, commit_sha), paths)
+        lines = (json.dumps(result) + '\n' for result in results)
+        return StreamingHttpResponse(lines, content_type='application/x-ndjson')
 
 class HtmlLocalGithubToHtmlView(GithubToHtmlMixin, TemplateView):
+    """
+    fetched ブランチのページを表示する
+
+    /local/<ref>:<path> にすると、ref (ブランチ名やコミットの SHA) の時点のページを表示する。
+    """
     template_name = 'app/markdown_to_html.html'
 
+    def parse_paths(self, paths):
+        ref, sep, path = paths.partition(':')
+        if not sep:
+            ref, path = None, paths
+        # ref は一度だけコミットの SHA にして、以降はそのコミットから読む
+        try:
+            self.commit_sha = models.resolve_snapshot(ref)
+        except gitobj.GitObjectError:
+            raise Http404
+        return super(HtmlLocalGithubToHtmlView, self).parse_paths(path)
+
+    def get_blob(self, paths):
+        try:
+            return models.get_blob_by_path(paths, self.commit_sha)
+        except IOError:
+            raise Http404
+
 class HtmlGithubToHtmlView(GithubToHtmlMixin, TemplateView):
     template_name = 'app/markdown_to_html.html'
 
-    def get_html_content(self, paths):
+    def get_blob(self, paths):
         # html 表示の場合は最新のものを取ってくる
-        return models.get_latest_html_content_by_path(paths)
+        return models.get_latest_blob_by_path(paths)
 
 class ContentsView(JSONResponseMixin, TemplateView):
     def get_context_data(self, **kwargs):
@@ -72,14 +233,98 @@ class ContentsView(JSONResponseMixin, TemplateView):
         return context
 
 class AllContentsView(JSONResponseMixin, TemplateView):
+    """
+    prefix=reference/vector でその下だけ、depth=N で prefix から N 階層までに絞る。
+    limit=N を付けると N 個ずつ返し、続きは next_cursor を cursor= に渡して取得する。
+    """
+    stream_json = True
+
+    def get(self, request, *args, **kwargs):
+        try:
+            self.depth = self.get_int_param('depth', 1)
+            self.limit = self.get_int_param('limit', 1)
+        except ValueError as e:
+            return self.render_to_response({'success': False, 'error': str(e)}, status=400)
+        return super(AllContentsView, self).get(request, *args, **kwargs)
+
+    def get_int_param(self, name, minimum):
+        """name の値を整数にして返す。無ければ None。minimum より小さければ ValueError"""
+        value = self.request.GET.get(name)
+        if value is None:
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError('{name} must be an integer'.format(name=name))
+        if value < minimum:
+            raise ValueError('{name} must be at least {minimum}'.format(name=name, minimum=minimum))
+        return value
+
     def get_context_data(self, **kwargs):
-        contents = models.get_all_contents()
+        params = self.request.GET
+        prefix = params.get('prefix')
+        cursor = params.get('cursor')
+        if prefix is None and self.depth is None and cursor is None and self.limit is None:
+            return {
+                "contents": models.get_all_contents()
+            }
 
+        contents, next_cursor = models.query_all_contents(
+            prefix=prefix,
+            depth=self.depth,
+            cursor=cursor,
+            limit=self.limit)
         context = {
-            "contents": contents
+            "contents": contents,
+            "next_cursor": next_cursor,
         }
         return context
 
+class MetricsView(View):
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(metrics.format_prometheus(), content_type='text/plain; version=0.0.4')
+
+class SearchView(JSONResponseMixin, View):
+    """GET /search?q=<語>&limit=<件数> で全文検索する"""
+    max_limit = 100
+
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get('q', '')
+        try:
+            limit = min(int(request.GET.get('limit', 20)), self.max_limit)
+        except ValueError:
+            limit = 20
+        results = models.search_pages(query, limit)
+        if results is None:
+            # 索引がまだ無いので裏で作る。作っている最中なら、そのジョブを返す
+            job_id = jobs.get_runner().submit_once('search_index', jobs.update_search_index)
+            return self.render_to_response({'success': False, 'error': 'search index is being built', 'job': job_id}, status=503)
+        return self.render_to_response({'success': True, 'query': query, 'results': results})
+
+class BrokenLinksView(JSONResponseMixin, View):
+    def get(self, request, *args, **kwargs):
+        return self.render_to_response(models.get_broken_links())
+
+class StatsView(JSONResponseMixin, TemplateView):
+    def get_context_data(self, **kwargs):
+        context = models.get_stats()
+        context['boot'] = boot.stats()
+        return context
+
+class WarmUpView(JSONResponseMixin, TemplateView):
+    def get_context_data(self, **kwargs):
+        return jobs.get_warm_up_status()
+
+class JobView(JSONResponseMixin, View):
+    def get(self, request, job_id=None, *args, **kwargs):
+        runner = jobs.get_runner()
+        if job_id is None:
+            return self.render_to_response({'jobs': runner.list()})
+        job = runner.get(job_id)
+        if job is None:
+            raise Http404
+        return self.render_to_response(job)
+
 class StartView(EchoMixin, JSONResponseMixin, View):
     def get_context_data(self, **kwargs):
         context = {
@@ -89,12 +334,9 @@ class StartView(EchoMixin, JSONResponseMixin, View):
         return context
 
     def post(self, request, *args, **kwargs):
-        message = models.git_fetch(settings.GIT_REMOTE)
-        self.echo(message)
-        models.git_checkout(settings.GIT_LOCAL_FETCHED)
-        message = models.git_merge(settings.GIT_REMOTE_BRANCH)
-        self.echo(message)
-        context = self.get_context_data(message=message)
+        job = jobs.get_runner().submit('start', jobs.start)
+        self.echo('start: job {id}'.format(id=job.id))
+        context = self.get_context_data(job=job.id)
         return self.render_to_response(context)
 
 class CommitView(EchoMixin, JSONResponseMixin, View):
@@ -106,14 +348,9 @@ class CommitView(EchoMixin, JSONResponseMixin, View):
         return context
 
     def post(self, request, *args, **kwargs):
-        models.resolve_errors()
-
-        models.git_checkout(settings.GIT_LOCAL_BRANCH)
-        message = models.git_merge(settings.GIT_LOCAL_FETCHED)
-        self.echo(message)
-        models.git_checkout(settings.GIT_LOCAL_FETCHED)
-
-        context = self.get_context_data(message=message)
+        job = jobs.get_runner().submit('commit', jobs.commit)
+        self.echo('commit: job {id}'.format(id=job.id))
+        context = self.get_context_data(job=job.id)
         return self.render_to_response(context)
 
 class ErrorView(EchoMixin, JSONResponseMixin, View):
@@ -129,10 +366,29 @@ class ErrorView(EchoMixin, JSONResponseMixin, View):
         next_trigger_at = request.POST.get('nexttriggerat').encode('utf-8')
         self.echo(errors)
         self.echo(next_trigger_at)
-        models.register_errors(errors, next_trigger_at)
+        try:
+            models.register_errors(errors, next_trigger_at)
+        except github.RateLimitExceeded as e:
+            # API の残りが無いので、リセットされてから送り直してもらう
+            response = self.render_to_response(self.get_context_data(success=False, error=str(e)), status=503)
+            response['Retry-After'] = str(max(1, int(e.reset_at - time.time())))
+            return response
         context = self.get_context_data()
         return self.render_to_response(context);
 
+class ValidateView(EchoMixin, JSONResponseMixin, View):
+    """
+    追加・更新されたページをサーバで全て変換してみて、エラーになったものを issue に書く
+
+    ページごとに /html を呼んで /errors に送る代わりに使う。
+    """
+
+    def post(self, request, *args, **kwargs):
+        next_trigger_at = request.POST.get('nexttriggerat', '').encode('utf-8')
+        job = jobs.get_validation_runner().submit('validate', lambda job: jobs.validate(job, next_trigger_at))
+        self.echo('validate: job {id}'.format(id=job.id))
+        return self.render_to_response({'success': True, 'job': job.id})
+
 class OAuthView(View):
     # GET https://github.com/login/oauth/authorize?client_id=5163f9957aabe66d2ce4&scope=public_repo
     def get(self, request):
@@ -0,0 +1,117 @@
+#coding: utf-8
+"""
+リクエストをまたいで使い回すワーカーのプール
+"""
+import os
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from app import models
+
+# 名前 -> (プール, 作ったプロセスの pid)
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(name, size):
+    # fork した子プロセスでは親のスレッドが動いていないので作り直す
+    with _pools_lock:
+        pool, pid = _pools.get(name, (None, None))
+        if pool is None or pid != os.getpid():
+            pool = ThreadPool(size)
+            _pools[name] = (pool, os.getpid())
+        return pool
+
+def get_render_pool():
+    """ページの変換に使うスレッドプールを返す"""
+    return _get_pool('render', settings.RENDER_POOL_SIZE)
+
+def get_warm_up_pool():
+    """キャッシュの事前変換に使うスレッドプールを返す
+
+    リクエストを受けて変換するプールとは分けて、事前変換が詰まっていても
+    /batch などが待たされないようにする。
+    """
+    return _get_pool('warm_up', settings.WARM_UP_POOL_SIZE)
+
+# 状態として返す、遅かったページの数
+WARM_UP_SLOWEST_COUNT = 10
+# 進み具合を知らせる間隔（秒）
+WARM_UP_REPORT_INTERVAL = 1.0
+
+class WarmUp(object):
+    """一回分の事前変換の進み具合
+
+    on_progress を渡すと、進み具合 (status()) を時々と終わったときに渡して呼ぶ。
+    """
+
+    def __init__(self, paths, on_progress=None):
+        self.paths = paths
+        self.on_progress = on_progress
+        self.done = 0
+        self.errors = []
+        self.timings = []
+        self.started_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._report_lock = threading.Lock()
+        self._reported_at = None
+
+    def _render(self, path):
+        start = time.time()
+        error = None
+        try:
+            models.render_path(path)
+        except Exception as e:
+            error = '{name}: {message}'.format(name=type(e).__name__, message=e)
+        seconds = time.time() - start
+        with self._lock:
+            self.done += 1
+            self.timings.append((seconds, path))
+            if error is not None:
+                self.errors.append({'path': path, 'error': error})
+            if self.done == len(self.paths):
+                self.finished_at = time.time()
+        self._report()
+
+    def _report(self, force=False):
+        if self.on_progress is None:
+            return
+        with self._report_lock:
+            now = time.time()
+            # 状態はロックの中で作るので、古い状態で新しいものを上書きすることはない
+            status = self.status()
+            if force or status['state'] == 'done' or self._reported_at is None or now - self._reported_at >= WARM_UP_REPORT_INTERVAL:
+                self.on_progress(status)
+                self._reported_at = now
+
+    def start(self, pool):
+        if not self.paths:
+            self.finished_at = self.started_at
+        self._report(force=True)
+        for path in self.paths:
+            pool.apply_async(self._render, (path,))
+
+    def status(self):
+        with self._lock:
+            finished_at = self.finished_at
+            elapsed = (finished_at or time.time()) - self.started_at
+            return {
+                'state': 'done' if finished_at is not None else 'running',
+                'total': len(self.paths),
+                'done': self.done,
+                'failed': len(self.errors),
+                'errors': list(self.errors),
+                'started_at': self.started_at,
+                'finished_at': finished_at,
+                'elapsed': elapsed,
+                'pages_per_second': self.done / elapsed if elapsed > 0 else None,
+                'slowest': [{'path': path, 'seconds': seconds}
+                            for seconds, path in sorted(self.timings, reverse=True)[:WARM_UP_SLOWEST_COUNT]],
+            }
+
+def start_warm_up(paths, on_progress=None):
+    """paths のページを裏で変換してキャッシュに入れる。終わるのは待たない"""
+    warm_up = WarmUp(list(paths), on_progress)
+    warm_up.start(get_warm_up_pool())
+    return warm_up
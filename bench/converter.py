@@ -0,0 +1,80 @@
+#coding: utf-8
+"""
+Markdown 変換器を使い回した場合と、ページごとに作り直した場合の変換時間を比べる
+
+    $ python bench/converter.py [cpprefjp/site のディレクトリ] [--limit N] [--repeat N]
+
+ディレクトリを省略すると settings.GIT_DIR を使う。
+"""
+import os
+import sys
+import time
+import argparse
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "andare.settings")
+
+import markdown
+from django.conf import settings
+from app import models
+
+def find_pages(root, limit):
+    pages = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for filename in sorted(filenames):
+            if filename.endswith('.md'):
+                path = os.path.join(dirpath, filename)
+                pages.append(os.path.relpath(path, root).split(os.sep))
+                if limit and len(pages) >= limit:
+                    return pages
+    return pages
+
+def convert_fresh(text, paths):
+    # 変換器をページごとに作っていた頃と同じ処理
+    extensions = list(models.MARKDOWN_EXTENSIONS)
+    for name, configs in models._page_extensions(paths):
+        extensions.append('{name}({configs})'.format(
+            name=name,
+            configs=', '.join('{0}={1}'.format(k, v) for k, v in configs)))
+    return markdown.Markdown(extensions).convert(text)
+
+def convert_pooled(text, paths):
+    return models._converter_pool.convert(text, models._page_extensions(paths))
+
+def run(convert, corpus, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        for paths, text in corpus:
+            convert(text, paths)
+    return (time.time() - start) / (repeat * len(corpus))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', nargs='?', default=settings.GIT_DIR)
+    parser.add_argument('--limit', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = []
+    for paths in find_pages(args.root, args.limit):
+        title, md = models._split_title(open(os.path.join(args.root, *paths)).read())
+        corpus.append((paths, unicode(md, encoding='utf-8')))
+    if not corpus:
+        sys.exit('no markdown files in {root}'.format(root=args.root))
+
+    # 使い回しても変換結果が変わらないことを確かめる
+    for paths, text in corpus:
+        if convert_fresh(text, paths) != convert_pooled(text, paths):
+            sys.exit('pooled converter differs on {path}'.format(path='/'.join(paths)))
+
+    fresh = run(convert_fresh, corpus, args.repeat)
+    pooled = run(convert_pooled, corpus, args.repeat)
+    print '{count} pages x {repeat}'.format(count=len(corpus), repeat=args.repeat)
+    print 'fresh:  {0:8.3f} ms/page'.format(fresh * 1000)
+    print 'pooled: {0:8.3f} ms/page'.format(pooled * 1000)
+    print 'speedup: {0:.2f}x'.format(fresh / pooled)
+
+if __name__ == '__main__':
+    main()
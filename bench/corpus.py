@@ -0,0 +1,148 @@
+#coding: utf-8
+"""
+ベンチマーク用に cpprefjp 風の Markdown と git リポジトリを作る
+
+同じ seed からは毎回同じ内容ができるので、別の日の計測結果と比べられる。
+"""
+import os
+import random
+import subprocess
+
+HEADERS = ['vector', 'map', 'string', 'memory', 'algorithm', 'utility', 'thread', 'chrono', 'regex', 'tuple']
+MEMBERS = ['begin', 'end', 'size', 'empty', 'insert', 'erase', 'clear', 'swap', 'find', 'count',
+           'at', 'front', 'back', 'push_back', 'pop_back', 'emplace', 'reserve', 'resize', 'op_assign', 'op_equal']
+WORDS = [u'要素', u'コンテナ', u'イテレータ', u'参照', u'返す', u'追加', u'削除', u'サイズ', u'例外',
+         u'計算量', u'定数時間', u'線形時間', u'範囲', u'型', u'値', u'比較', u'構築', u'破棄']
+
+PAGE_TEMPLATE = u"""#{name}
+* {header}[meta header]
+* std[meta namespace]
+* {klass}[meta class]
+* function[meta id-type]
+
+```cpp
+{signature}
+```
+
+##概要
+{summary}
+
+##戻り値
+{summary2}
+
+##例
+```cpp
+#include <iostream>
+#include <{header}>
+
+int main()
+{{
+  std::{klass}<int> v = {{{values}}};
+  auto it = v.{name}();
+  for (int x : v) {{
+    std::cout << x << std::endl;
+  }}
+}}
+```
+* v.{name}()[color ff0000]
+
+###出力
+```
+{output}
+```
+
+##参照
+- [{klass}](/reference/{header}/{klass}.md)
+- [{other}](/reference/{header}/{klass}/{other}.md)
+"""
+
+def _sentence(rng, count):
+    return u''.join(rng.choice(WORDS) for _ in range(count)) + u'。'
+
+def generate_page(rng, header, klass, name):
+    values = [rng.randint(0, 100) for _ in range(rng.randint(3, 8))]
+    return PAGE_TEMPLATE.format(
+        name=name,
+        header=header,
+        klass=klass,
+        signature=u'iterator {name}();\nconst_iterator {name}() const;'.format(name=name),
+        summary=u'\n'.join(_sentence(rng, rng.randint(5, 15)) for _ in range(rng.randint(1, 4))),
+        summary2=_sentence(rng, rng.randint(3, 10)),
+        values=u', '.join(unicode(v) for v in values),
+        output=u'\n'.join(unicode(v) for v in values),
+        other=rng.choice(MEMBERS),
+    )
+
+def generate_paths(count, seed=0):
+    """reference/<ヘッダ>/<クラス>/<メンバ>.md の形のパスを count 個作る"""
+    rng = random.Random(seed)
+    paths = []
+    i = 0
+    while len(paths) < count:
+        header = HEADERS[i % len(HEADERS)]
+        klass = '{header}{n}'.format(header=header, n=i // len(HEADERS))
+        for member in MEMBERS:
+            if len(paths) >= count:
+                break
+            if rng.random() < 0.8:
+                paths.append('reference/{header}/{klass}/{member}.md'.format(header=header, klass=klass, member=member))
+        i += 1
+    return paths
+
+def generate_corpus(count, seed=0):
+    """[(パス, Markdown のテキスト)] を作る"""
+    rng = random.Random(seed)
+    corpus = []
+    for path in generate_paths(count, seed):
+        _, header, klass, member = path.split('/')
+        corpus.append((path, generate_page(rng, header, klass, member.split('.')[0])))
+    return corpus
+
+def _git(git_dir, *args):
+    return subprocess.check_output(('git',) + args, cwd=git_dir).strip()
+
+def _write(root, path, text):
+    filename = os.path.join(root, *path.split('/'))
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(filename, 'wb') as f:
+        f.write(text.encode('utf-8'))
+
+def make_repository(root, count, changes, seed=0):
+    """root に settings.GIT_DIR として使える git リポジトリを作る
+
+    master に count ページを入れたコミットを作り、そこから changes ページを
+    追加・更新・削除したコミットを origin/master と fetched にする。
+    fetched にあるページのパスを返す。
+    """
+    os.makedirs(root)
+    _git(root, 'init', '-q')
+    _git(root, 'config', 'user.name', 'bench')
+    _git(root, 'config', 'user.email', 'bench@example.com')
+    corpus = generate_corpus(count + changes, seed)
+    base, extra = corpus[:count], corpus[count:]
+    for path, text in base:
+        _write(root, path, text)
+    _write(root, 'README.md', u'#README\n')
+    _git(root, 'add', '-A')
+    _git(root, 'commit', '-q', '-m', 'base')
+    _git(root, 'branch', '-M', 'master')
+
+    rng = random.Random(seed + 1)
+    for path, text in extra:
+        _write(root, path, text)
+    for path, text in rng.sample(base, min(changes, len(base))):
+        _write(root, path, text + u'\n' + _sentence(rng, 5) + u'\n')
+    for path, _ in rng.sample(base, min(changes // 4, len(base))):
+        filename = os.path.join(root, *path.split('/'))
+        if os.path.exists(filename):
+            os.remove(filename)
+    _git(root, 'add', '-A')
+    _git(root, 'commit', '-q', '-m', 'update')
+    updated = _git(root, 'rev-parse', 'HEAD')
+    _git(root, 'update-ref', 'refs/remotes/origin/master', updated)
+    _git(root, 'branch', 'fetched', updated)
+    _git(root, 'checkout', '-q', 'fetched')
+    _git(root, 'branch', '-f', 'master', 'HEAD~1')
+    return [path for path, _ in corpus if os.path.exists(os.path.join(root, *path.split('/')))]
@@ -0,0 +1,330 @@
+#coding: utf-8
+"""
+ローカルの git リポジトリを元に GitHub API の代わりをするサーバ
+
+    $ python bench/fakegithub.py [git のディレクトリ] [--port 8001] [--branch fetched]
+                                 [--latency 0.05] [--jitter 0.02]
+                                 [--rate-limit 5000] [--rate-window 3600]
+                                 [--search-rate-limit 30] [--search-rate-window 60] [--issues 500]
+
+andare が使う API（refs, trees, blobs, issues, issue の検索）だけを返す。andare 側は
+settings.GITHUB_API_URL を http://127.0.0.1:8001 にすれば、api.github.com の
+代わりにこのサーバを使う（.access_token はファイルがあれば中身は何でもよい）。
+
+heads/master の参照は --branch のコミットを返す。--latency と --jitter で
+レスポンスごとに遅延を入れ、--rate-limit と --rate-window で X-RateLimit-* ヘッダを
+付けて、使い切ったら 403 を返す。GitHub と同じく issue の検索は別に数え、
+--search-rate-limit と --search-rate-window で制限する (X-RateLimit-Resource: search)。
+--issues の数だけ閉じた issue を最初から作っておく。
+"""
+import os
+import sys
+import json
+import time
+import base64
+import random
+import hashlib
+import urlparse
+import argparse
+import threading
+import subprocess
+import SocketServer
+import BaseHTTPServer
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+from app import gitobj
+
+class RateLimit(object):
+    """window 秒ごとに limit 回まで。resource は X-RateLimit-Resource に入れる種類"""
+
+    def __init__(self, limit, window, resource='core'):
+        self.resource = resource
+        self.limit = limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._reset_at = time.time() + window
+        self._remaining = limit
+
+    def take(self):
+        """一回分使って (使えたか, 残り, リセットされる時刻) を返す"""
+        with self._lock:
+            now = time.time()
+            if now >= self._reset_at:
+                self._reset_at = now + self.window
+                self._remaining = self.limit
+            if self._remaining <= 0:
+                return False, 0, int(self._reset_at)
+            self._remaining -= 1
+            return True, self._remaining, int(self._reset_at)
+
+    def peek(self):
+        """使わずに (残り, リセットされる時刻) を返す"""
+        with self._lock:
+            return self._remaining, int(self._reset_at)
+
+    def headers(self, remaining, reset_at):
+        return [
+            ('X-RateLimit-Limit', str(self.limit)),
+            ('X-RateLimit-Remaining', str(remaining)),
+            ('X-RateLimit-Reset', str(reset_at)),
+            ('X-RateLimit-Resource', self.resource),
+        ]
+
+class Issues(object):
+    def __init__(self):
+        self._issues = []
+        self._lock = threading.Lock()
+
+    def create(self, data, state='open'):
+        with self._lock:
+            issue = {
+                'number': len(self._issues) + 1,
+                'title': data.get('title', ''),
+                'body': data.get('body', ''),
+                'state': state,
+            }
+            self._issues.append(issue)
+            return dict(issue)
+
+    def update(self, number, data):
+        with self._lock:
+            if not 1 <= number <= len(self._issues):
+                return None
+            issue = self._issues[number - 1]
+            for key in ('title', 'body'):
+                if key in data:
+                    issue[key] = data[key]
+            if 'state' in data:
+                # andare は 'close' を送ってくる
+                issue['state'] = 'closed' if data['state'].startswith('close') else data['state']
+            return dict(issue)
+
+    def get(self, number):
+        with self._lock:
+            if not 1 <= number <= len(self._issues):
+                return None
+            return dict(self._issues[number - 1])
+
+    def search(self, query):
+        """"タイトル" in:title と state: だけを解釈する"""
+        title = None
+        state = 'all'
+        if '"' in query:
+            title = query.split('"')[1]
+        for term in query.split():
+            if term.startswith('state:'):
+                state = term[len('state:'):]
+        return [issue for issue in self.list(state) if title is None or title in issue['title']]
+
+    def list(self, state):
+        with self._lock:
+            # GitHub と同じく新しい順
+            return [dict(issue) for issue in reversed(self._issues) if state == 'all' or issue['state'] == state]
+
+class FakeGithub(object):
+    def __init__(self, git_dir, branch, latency=0.0, jitter=0.0, rate_limit=None, search_rate_limit=None):
+        self.git_dir = git_dir
+        self.branch = branch
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.search_rate_limit = search_rate_limit
+        self.repository = gitobj.Repository(git_dir)
+        self.issues = Issues()
+        # ツリーは SHA が同じなら中身も同じなので覚えておく
+        self._trees = {}
+        self._trees_lock = threading.Lock()
+
+    def get_ref(self, ref):
+        if ref != 'heads/master':
+            return None
+        sha = self.repository.resolve(self.branch)
+        return {'ref': 'refs/' + ref, 'object': {'sha': sha, 'type': 'commit'}}
+
+    def get_tree(self, sha, recursive):
+        key = (sha, recursive)
+        with self._trees_lock:
+            tree = self._trees.get(key)
+        if tree is not None:
+            return tree
+        args = ['git', 'ls-tree', '-z', '-l'] + (['-r', '-t'] if recursive else []) + [sha]
+        try:
+            output = subprocess.check_output(args, cwd=self.git_dir, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            return None
+        entries = []
+        for line in output.split('\0'):
+            if not line:
+                continue
+            meta, path = line.split('\t', 1)
+            mode, type, object_sha, size = meta.split()
+            entry = {'path': path, 'mode': mode, 'type': type, 'sha': object_sha}
+            if type == 'blob':
+                entry['size'] = int(size)
+            entries.append(entry)
+        tree = {'sha': sha, 'tree': entries, 'truncated': False}
+        with self._trees_lock:
+            self._trees[key] = tree
+        return tree
+
+    def get_blob(self, sha):
+        obj = self.repository.read(sha)
+        if obj is None or obj.type != 'blob':
+            return None
+        return {'sha': obj.sha, 'size': obj.size, 'content': base64.b64encode(obj.data), 'encoding': 'base64'}
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def github(self):
+        return self.server.github
+
+    def _send(self, status, body=None, headers=()):
+        data = json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        github = self.github
+        delay = github.latency + random.uniform(-github.jitter, github.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        parts = url.path.strip('/').split('/')
+        # /repos/<user>/<repo>/... か /search/issues
+        rate_limit = github.rate_limit
+        if parts == ['search', 'issues']:
+            rate_limit = github.search_rate_limit
+        elif len(parts) < 4 or parts[0] != 'repos':
+            return self._send(404, {'message': 'Not Found'})
+        else:
+            parts = parts[3:]
+
+        body = None
+        if method in ('POST', 'PATCH'):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length) or '{}')
+
+        status, result, headers = self._route(method, parts, query, body)
+        if status == 200 and method == 'GET':
+            etag = '"{0}"'.format(hashlib.sha1(json.dumps(result, sort_keys=True)).hexdigest())
+            headers.append(('ETag', etag))
+            # 304 は GitHub でも回数に数えられない
+            if self.headers.get('If-None-Match') == etag:
+                if rate_limit is not None:
+                    headers.extend(rate_limit.headers(*rate_limit.peek()))
+                return self._send(304, None, headers)
+
+        if rate_limit is not None:
+            allowed, remaining, reset_at = rate_limit.take()
+            headers.extend(rate_limit.headers(remaining, reset_at))
+            if not allowed:
+                return self._send(403, {'message': 'API rate limit exceeded'}, headers)
+        self._send(status, result, headers)
+
+    def _route(self, method, parts, query, body):
+        github = self.github
+        headers = []
+        result = None
+        if method == 'GET' and parts[:2] == ['git', 'refs']:
+            result = github.get_ref('/'.join(parts[2:]))
+        elif method == 'GET' and parts[:2] == ['git', 'trees'] and len(parts) == 3:
+            result = github.get_tree(parts[2], query.get('recursive') == '1')
+        elif method == 'GET' and parts[:2] == ['git', 'blobs'] and len(parts) == 3:
+            result = github.get_blob(parts[2])
+        elif parts == ['issues'] and method == 'GET':
+            issues = github.issues.list(query.get('state', 'open'))
+            per_page = int(query.get('per_page', 30))
+            page = int(query.get('page', 1))
+            result = issues[(page - 1) * per_page:page * per_page]
+            if page * per_page < len(issues):
+                next_query = dict(query, page=page + 1, per_page=per_page)
+                headers.append(('Link', '<http://{host}{path}?{query}>; rel="next"'.format(
+                    host=self.headers.get('Host'), path=urlparse.urlparse(self.path).path,
+                    query='&'.join('{0}={1}'.format(k, v) for k, v in sorted(next_query.items())))))
+        elif parts == ['search', 'issues'] and method == 'GET':
+            items = github.issues.search(query.get('q', ''))
+            result = {'total_count': len(items), 'incomplete_results': False, 'items': items[:100]}
+        elif len(parts) == 2 and parts[0] == 'issues' and method == 'GET':
+            result = github.issues.get(int(parts[1]))
+        elif parts == ['issues'] and method == 'POST':
+            return 201, github.issues.create(body), headers
+        elif len(parts) == 2 and parts[0] == 'issues' and method == 'PATCH':
+            result = github.issues.update(int(parts[1]), body)
+        if result is None:
+            return 404, {'message': 'Not Found'}, headers
+        return 200, result, headers
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, github):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.github = github
+
+def start(github, port=0):
+    """別スレッドでサーバを起動して返す。ポートは server.server_port"""
+    server = Server(('127.0.0.1', port), github)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('git_dir', nargs='?', default=os.path.join(PROJECT_DIR, '..', 'cpprefjp', 'site'))
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--branch', default='fetched', help='branch served as heads/master')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random +/- seconds added to the latency')
+    parser.add_argument('--rate-limit', type=int, help='requests allowed per window (default: unlimited)')
+    parser.add_argument('--rate-window', type=int, default=3600, help='seconds until the limit resets')
+    parser.add_argument('--search-rate-limit', type=int,
+                        help='issue searches allowed per window (default: 30 if --rate-limit is given, otherwise unlimited)')
+    parser.add_argument('--search-rate-window', type=int, default=60, help='seconds until the search limit resets')
+    parser.add_argument('--issues', type=int, default=0, help='closed issues to create up front')
+    args = parser.parse_args()
+
+    rate_limit = RateLimit(args.rate_limit, args.rate_window) if args.rate_limit is not None else None
+    search_limit = args.search_rate_limit
+    if search_limit is None and args.rate_limit is not None:
+        search_limit = 30
+    search_rate_limit = RateLimit(search_limit, args.search_rate_window, 'search') if search_limit is not None else None
+    github = FakeGithub(args.git_dir, args.branch, args.latency, args.jitter, rate_limit, search_rate_limit)
+    for i in range(args.issues):
+        github.issues.create({'title': 'Old issue {0}'.format(i + 1), 'body': ''}, state='closed')
+
+    server = Server(('127.0.0.1', args.port), github)
+    print 'serving {git_dir} ({branch}) on http://127.0.0.1:{port}'.format(
+        git_dir=args.git_dir, branch=args.branch, port=server.server_port)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#coding: utf-8
+"""
+起動している andare に並行してリクエストを送り、スループットとレイテンシを計測する
+
+    $ python bench/fakegithub.py --latency 0.05 &
+    $ python manage.py runserver 8080   # settings.GITHUB_API_URL = 'http://127.0.0.1:8001'
+    $ python bench/load.py http://127.0.0.1:8080/andare --concurrency 8 --duration 30 \\
+          --mix view=6,html=3,errors=1 [--output result.json]
+
+/view/<path> と /html/<path> のパスは git リポジトリ（省略すると settings.GIT_DIR）の
+--branch にあるページから選ぶ。/errors には適当なページを一つ含むエラーを POST する。
+エンドポイントごとと全体のスループットと p50/p95/p99 を JSON で出力する。
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+import requests
+from requests.adapters import HTTPAdapter
+from app import gitobj
+
+def percentile(samples, p):
+    """ソート済みの samples の p パーセンタイル
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 99)
+    4
+    """
+    if not samples:
+        return None
+    index = int(math.ceil(len(samples) * p / 100.0)) - 1
+    return samples[min(max(index, 0), len(samples) - 1)]
+
+def summarize(samples, errors, statuses, elapsed):
+    samples = sorted(samples)
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'statuses': statuses,
+        'throughput': len(samples) / elapsed if elapsed else None,
+        'mean': sum(samples) / len(samples) if samples else None,
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'p99': percentile(samples, 99),
+        'max': samples[-1] if samples else None,
+    }
+
+def parse_mix(mix):
+    weights = []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in ('view', 'html', 'errors'):
+            raise argparse.ArgumentTypeError('unknown endpoint: {0}'.format(name))
+        weights.append((name, int(weight or 1)))
+    return weights
+
+def list_pages(git_dir, branch):
+    repo = gitobj.Repository(git_dir)
+    try:
+        return [path for _, path in repo.ls_tree(branch) if path.endswith('.md')]
+    finally:
+        repo.close()
+
+class Recorder(object):
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, seconds, status):
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            statuses = self.statuses.setdefault(endpoint, {})
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status is None or status >= 400:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+def request(session, base_url, endpoint, path, timeout):
+    if endpoint == 'view':
+        return session.get('{0}/view/{1}'.format(base_url, path), timeout=timeout)
+    if endpoint == 'html':
+        return session.get('{0}/html/{1}'.format(base_url, path), timeout=timeout)
+    return session.post('{0}/errors'.format(base_url), timeout=timeout, data={
+        'errors': json.dumps([path]),
+        'nexttriggerat': time.strftime('%Y-%m-%d %H:%M:%S'),
+    })
+
+def worker(base_url, pages, weights, deadline, remaining, recorder, timeout, seed):
+    rng = random.Random(seed)
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_maxsize=1))
+    choices = [name for name, weight in weights for _ in range(weight)]
+    while time.time() < deadline:
+        # 総リクエスト数の指定があれば、残りを全スレッドで分け合う
+        if remaining is not None:
+            with remaining[1]:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+        endpoint = rng.choice(choices)
+        path = rng.choice(pages)
+        start = time.time()
+        try:
+            status = request(session, base_url, endpoint, path, timeout).status_code
+        except requests.RequestException:
+            status = None
+        recorder.add(endpoint, time.time() - start, status)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('base_url', help='e.g. http://127.0.0.1:8080/andare')
+    parser.add_argument('--git-dir', default=os.path.join(PROJECT_DIR, '..', 'cpprefjp', 'site'))
+    parser.add_argument('--branch', default='fetched')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run')
+    parser.add_argument('--requests', type=int, help='stop after this many requests')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('view=6,html=3,errors=1'))
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    args = parser.parse_args()
+
+    pages = list_pages(args.git_dir, args.branch)
+    if not pages:
+        sys.exit('no pages in {0} ({1})'.format(args.git_dir, args.branch))
+
+    recorder = Recorder()
+    remaining = [args.requests, threading.Lock()] if args.requests is not None else None
+    start = time.time()
+    deadline = start + args.duration
+    threads = [threading.Thread(target=worker, args=(args.base_url.rstrip('/'), pages, args.mix, deadline,
+                                                     remaining, recorder, args.timeout, args.seed + i))
+               for i in range(args.concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    endpoints = dict((name, summarize(samples, recorder.errors.get(name, 0), recorder.statuses.get(name, {}), elapsed))
+                     for name, samples in recorder.samples.items())
+    statuses = {}
+    for counts in recorder.statuses.values():
+        for status, count in counts.items():
+            statuses[status] = statuses.get(status, 0) + count
+    report = {
+        'meta': {
+            'base_url': args.base_url,
+            'concurrency': args.concurrency,
+            'mix': dict(args.mix),
+            'pages': len(pages),
+            'elapsed': elapsed,
+            'time': start,
+        },
+        'total': summarize([s for samples in recorder.samples.values() for s in samples],
+                           sum(recorder.errors.values()), statuses, elapsed),
+        'endpoints': endpoints,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
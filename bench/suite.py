@@ -0,0 +1,190 @@
+#coding: utf-8
+"""
+変換と一覧の処理時間をまとめて計測して、結果を JSON で出力する
+
+    $ python bench/suite.py [--pages N] [--diff-paths N] [--repeat N] [--output result.json]
+    $ python bench/suite.py --baseline old.json
+
+ネットワークは使わない。生成したページで一時ディレクトリに git リポジトリを作り、
+settings.GIT_DIR をそこに向けて計測する。--baseline を指定すると、以前の結果と
+比べた比率を標準エラーに表示する。
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "andare.settings")
+
+from django.conf import settings
+from django.test.client import Client
+from app import models
+import corpus
+
+def measure(func, repeat, setup=None):
+    """func を repeat 回実行した時間（秒）の統計を返す"""
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        samples.append(time.time() - start)
+    samples.sort()
+    return {
+        'n': len(samples),
+        'mean': sum(samples) / len(samples),
+        'min': samples[0],
+        'median': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max': samples[-1],
+    }
+
+def per_item(result, count):
+    return dict(result, items=count, per_item_mean=result['mean'] / count)
+
+def clear_caches():
+    models._contents_cache.clear()
+    models.get_render_cache().memory.clear()
+    if models.highlight._cache is not None:
+        models.highlight._cache.clear()
+
+def bench_split_title(pages, repeat):
+    texts = [text for _, text in pages]
+    def run():
+        for text in texts:
+            models._split_title(text)
+    return per_item(measure(run, repeat), len(texts))
+
+def bench_md_to_html(pages, repeat):
+    inputs = [(path.split('/'), models._split_title(text)[1]) for path, text in pages]
+    def run():
+        for paths, md in inputs:
+            models._md_to_html(md, paths)
+    return per_item(measure(run, repeat), len(inputs))
+
+def bench_diff_to_contents(count, repeat):
+    commands = 'AMMMD'
+    diff = [models.DiffType(commands[i % len(commands)], path)
+            for i, path in enumerate(corpus.generate_paths(count, seed=1))]
+    return per_item(measure(lambda: models._diff_to_contents(diff), repeat), len(diff))
+
+def bench_all_contents(repeat):
+    return {
+        'cold': measure(models.get_all_contents, repeat, setup=models._contents_cache.clear),
+        'warm': measure(models.get_all_contents, repeat),
+    }
+
+def bench_views(paths, repeat):
+    client = Client()
+    page = '/andare/local/' + paths[0]
+    results = {}
+    results['local_cold'] = measure(lambda: client.get(page), repeat, setup=clear_caches)
+    results['local_warm'] = measure(lambda: client.get(page), repeat)
+    etag = client.get(page)['ETag']
+    results['local_not_modified'] = measure(lambda: client.get(page, HTTP_IF_NONE_MATCH=etag), repeat)
+    results['contents_cold'] = measure(lambda: client.get('/andare/contents'), repeat, setup=models._contents_cache.clear)
+    results['contents_warm'] = measure(lambda: client.get('/andare/contents'), repeat)
+    results['all_contents_warm'] = measure(lambda: ''.join(client.get('/andare/all_contents').streaming_content), repeat)
+    for name, response in [('local', client.get(page)), ('contents', client.get('/andare/contents'))]:
+        if response.status_code != 200:
+            raise RuntimeError('{name} returned {status}'.format(name=name, status=response.status_code))
+    return results
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_DIR, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(baseline, results, prefix=''):
+    """以前の結果と比べて、平均の比率を表示する"""
+    for name, value in sorted(results.items()):
+        old = baseline.get(name)
+        if not isinstance(value, dict) or not isinstance(old, dict):
+            continue
+        if 'mean' in value and 'mean' in old and old['mean']:
+            print >>sys.stderr, '{name:40s} {ratio:6.2f}x  ({old:.3f} ms -> {new:.3f} ms)'.format(
+                name=prefix + name, ratio=value['mean'] / old['mean'], old=old['mean'] * 1000, new=value['mean'] * 1000)
+        else:
+            compare(old, value, prefix + name + '.')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=300, help='pages in the git fixture')
+    parser.add_argument('--changes', type=int, default=100, help='pages added/updated between master and fetched')
+    parser.add_argument('--diff-paths', type=int, default=12000, help='paths given to _diff_to_contents')
+    parser.add_argument('--sample', type=int, default=100, help='pages used for _split_title/_md_to_html')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    parser.add_argument('--baseline', help='JSON of an earlier run to compare against')
+    parser.add_argument('--keep', action='store_true', help='keep the generated git repository')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='andare-bench-')
+    try:
+        git_dir = os.path.join(workdir, 'site')
+        start = time.time()
+        paths = corpus.make_repository(git_dir, args.pages, args.changes, args.seed)
+        setup_seconds = time.time() - start
+        settings.GIT_DIR = git_dir
+        # 計測中に他のキャッシュディレクトリや索引を汚さない
+        settings.RENDER_CACHE_DIR = None
+        settings.LINK_INDEX_PATH = os.path.join(workdir, 'links.sqlite3')
+        settings.SEARCH_INDEX_DIR = os.path.join(workdir, 'search')
+        models._link_index = None
+        models._search_index = None
+
+        # リポジトリから読んだときと同じく UTF-8 のバイト列にする
+        pages = [(path, text.encode('utf-8')) for path, text in corpus.generate_corpus(args.sample, args.seed)]
+        results = {
+            'split_title': bench_split_title(pages, args.repeat),
+            'md_to_html': bench_md_to_html(pages, args.repeat),
+            'diff_to_contents': bench_diff_to_contents(args.diff_paths, args.repeat),
+            'all_contents': bench_all_contents(args.repeat),
+            'views': bench_views(paths, args.repeat),
+        }
+    finally:
+        if args.keep:
+            print >>sys.stderr, 'git fixture kept in {0}'.format(workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'revision': revision(),
+            'renderer_version': models.RENDERER_VERSION,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'pages': args.pages,
+            'changes': args.changes,
+            'diff_paths': args.diff_paths,
+            'sample': args.sample,
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'setup_seconds': setup_seconds,
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f)['results'], results)
+
+if __name__ == '__main__':
+    main()